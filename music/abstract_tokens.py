@@ -1,48 +1,94 @@
 import os
-import sys
-from cluster_progressive import load_tokens, load_similarity_matrix, create_similarity_matrix, cluster_tokens, create_abstracted_tokens, save_abstracted_tokens
-def abstract_tokens(token_file, output_dir):
-    tokens = load_tokens(token_file)
+import argparse
+from cluster_progressive import load_tokens, load_similarity_matrix, create_similarity_matrix, cluster_tokens, cluster_similarity_graph, create_abstracted_tokens, save_abstracted_tokens
+from token_index import knn_graph_settings, token_knn_graph, save_similarity_graph, load_similarity_graph
+
+def cluster_dense(tokens, output_dir, distance_threshold):
+    '''
+    Average linkage on the full similarity matrix, saved to output_dir/similarity_matrix.npz
+    '''
     similarity_file = os.path.join(output_dir, 'similarity_matrix.npz')
-    abstracted_file = os.path.join(output_dir, 'abstracted_tokens.json')
-    
+
     if os.path.exists(similarity_file):
-        print("Loading pre-computed similarity matrix...")
-        similarity_matrix, _ = load_similarity_matrix(similarity_file)
+        similarity_matrix, _, completed_rows = load_similarity_matrix(similarity_file)
+        if completed_rows == len(tokens):
+            print("Loading pre-computed similarity matrix...")
+        else:
+            print(f"Resuming similarity matrix computation from row {completed_rows}...")
+            similarity_matrix = create_similarity_matrix(tokens, similarity_file)
     else:
         print("Computing similarity matrix...")
         similarity_matrix = create_similarity_matrix(tokens, similarity_file)
-    
+
+    print("Performing clustering...")
+    return cluster_tokens(similarity_matrix, distance_threshold=distance_threshold)
+
+def cluster_sparse(tokens, output_dir, distance_threshold, k=10):
+    '''
+    Connected components of the sparse kNN similarity graph (see token_index), saved to
+    output_dir/similarity_graph.npz
+    '''
+    graph_file = os.path.join(output_dir, 'similarity_graph.npz')
+    settings = knn_graph_settings(k)
+
+    graph = None
+    if os.path.exists(graph_file):
+        graph, graph_tokens, graph_settings = load_similarity_graph(graph_file)
+        if list(graph_tokens) == list(tokens.keys()) and graph_settings == settings:
+            print("Loading pre-computed similarity graph...")
+        else:
+            graph = None
+    if graph is None:
+        print("Computing similarity graph...")
+        graph = token_knn_graph(tokens, **settings)
+        save_similarity_graph(graph, list(tokens.keys()), graph_file, settings)
+
     print("Performing clustering...")
-    clusters = cluster_tokens(similarity_matrix, distance_threshold=0.2)
-    
+    return cluster_similarity_graph(graph, distance_threshold=distance_threshold)
+
+def abstract_tokens(token_file, output_dir, sparse=False, k=10):
+    '''
+    sparse: cluster on the kNN similarity graph instead of the full similarity matrix, for
+    vocabularies too large for all n^2 pairs
+    '''
+    tokens = load_tokens(token_file)
+    abstracted_file = os.path.join(output_dir, 'abstracted_tokens.json')
+
+    if sparse:
+        clusters = cluster_sparse(tokens, output_dir, 0.2, k)
+    else:
+        clusters = cluster_dense(tokens, output_dir, 0.2)
+
     print("Creating abstracted tokens...")
     abstracted_tokens = create_abstracted_tokens(tokens, clusters)
-    
+
     print("Saving abstracted tokens...")
     save_abstracted_tokens(abstracted_tokens, abstracted_file)
-    
+
     print(f"Number of original tokens: {len(tokens)}")
     print(f"Number of abstracted token groups: {len(abstracted_tokens)}")
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python abstract_tokens.py /path/to/token/file /path/to/save/abstracted/tokens")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Groups similar tokens into abstracted tokens")
+    parser.add_argument("token_file", help="/path/to/token/file")
+    parser.add_argument("output_dir", help="/path/to/save/abstracted/tokens")
+    parser.add_argument("--sparse", action="store_true", help="Cluster on a sparse kNN similarity graph instead of the full similarity matrix")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per token in the sparse graph")
+    args = parser.parse_args()
 
-    token_file = sys.argv[1]
-    output_dir = sys.argv[2]
+    token_file = args.token_file
+    output_dir = args.output_dir
 
     if not os.path.isfile(token_file):
         print(f"Error: Token file '{token_file}' does not exist.")
-        sys.exit(1)
+        raise SystemExit(1)
 
     os.makedirs(output_dir, exist_ok=True)
 
     print(f"Abstracting tokens from {token_file}")
     print(f"Saving results to {output_dir}")
 
-    abstract_tokens(token_file, output_dir)
+    abstract_tokens(token_file, output_dir, args.sparse, args.k)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,7 +1,16 @@
 import os
 import json
+from array import array
+import ast
+import multiprocessing
+import signal
+from functools import lru_cache
+import numpy as np
 from note_token import midi_to_note_sequence
-from encoding import generate_vocab_list, expand_token, deserialize, serialize
+from encoding import deserialize, serialize, new_token, Vocab, merge_ranks, encode_tokens
+from bpe import make_trainer, dedupe_sequences
+from packed_sequence import save_note_sequence, pack_note_sequence, encode_packed
+from corpus import NoteSequenceCorpus
 
 def preprocess_midi(midi_dir, processed_midi_dir = "processed_midi"):
     '''
@@ -30,10 +39,8 @@ def preprocess_midi(midi_dir, processed_midi_dir = "processed_midi"):
                 quantized_midi_path = os.path.join(midi_output_dir, f"{midi_name}_quantized.mid")
                 note_sequence = midi_to_note_sequence(midi_path, quantize_midi_file_name=quantized_midi_path)
 
-                # Save note sequence tokens in <midi_file_name>_seq.json
-                seq_json_path = os.path.join(midi_output_dir, f"{midi_name}_seq.json")
-                with open(seq_json_path, 'w') as f:
-                    json.dump({"seq": str(note_sequence)}, f, indent=2)
+                # Save note sequence tokens in <midi_file_name>_seq.json (and packed _seq.npy)
+                save_note_sequence(midi_output_dir, midi_name, note_sequence)
 
                 print(f"Processed {filename}")
         except:
@@ -46,6 +53,9 @@ def create_all_note_sequence_tokens(processed_midi_dir, separator="|"):
     '''
     Creates a list of all note sequence tokens from processed MIDI files,
     with separators between different sequences.
+
+    This holds the whole corpus in memory; the trainers also accept a
+    corpus.NoteSequenceCorpus, which streams the same tokens from disk.
     
     Args:
     processed_midi_dir (str): Path to the directory containing processed MIDI data
@@ -54,95 +64,103 @@ def create_all_note_sequence_tokens(processed_midi_dir, separator="|"):
     Returns:
     list: A list of all note sequence string tokens, including separators
     '''
-    all_note_sequence_tokens = []
+    return list(NoteSequenceCorpus(processed_midi_dir, separator))
 
-    # For each midi folder in processed_midi_dir
-    for midi_folder in os.listdir(processed_midi_dir):
-        folder_path = os.path.join(processed_midi_dir, midi_folder)
-        
-        if os.path.isdir(folder_path):
-            # Find the *_seq.json file in the folder
-            seq_file = next((f for f in os.listdir(folder_path) if f.endswith('_seq.json')), None)
-            
-            if seq_file:
-                seq_file_path = os.path.join(folder_path, seq_file)
-                
-                # Read the note sequence from the JSON file
-                with open(seq_file_path, 'r') as f:
-                    data = json.load(f)
-                    note_sequence = eval(data['seq'])  # Convert string representation to list
-                
-                # Serialize the note sequence
-                serialized_sequence = serialize(note_sequence)
-                
-                # Add each element of note sequence to all_note_sequence_tokens
-                all_note_sequence_tokens.extend(serialized_sequence)
-                
-                # Add separator to distinguish different note sequences
-                all_note_sequence_tokens.append(separator)
-    
-    # Remove the last separator if it exists
-    if all_note_sequence_tokens and all_note_sequence_tokens[-1] == separator:
-        all_note_sequence_tokens.pop()
+def create_trainer(vocab: Vocab, all_note_sequence_tokens, separator = "|", dedupe: bool = True, workers: int = 1):
+    '''
+    Encodes the corpus into ids and builds a BPETrainer over it.
 
-    return all_note_sequence_tokens
+    all_note_sequence_tokens can be a list or a streamed corpus.NoteSequenceCorpus; only the
+    int id array is kept in memory.
 
-def batch_generate_vocab_list(all_note_sequence_tokens: list[str], num_merges, save_every_n_merges: int = 500, separator = "|", tokens_dir = "tokens"):
+    dedupe: store each distinct separator-bounded sequence once, weighted by how often it
+    repeats. Merges and frequencies are the same, only the working set shrinks.
+    workers: if > 1, shard the corpus over that many processes (ParallelBPETrainer).
+    The merges are the same as with a single process.
+    '''
+    corpus = vocab.encode(all_note_sequence_tokens)
+    separator_id = vocab.ids.get(separator, -1)
+    weights = None
+    if dedupe:
+        unique_corpus, weights = dedupe_sequences(corpus, separator_id)
+        print(f"Deduplicated corpus: {len(corpus)} -> {len(unique_corpus)} tokens")
+        corpus = unique_corpus
+    return make_trainer(corpus, separator_id, weights, workers)
+
+def batch_generate_vocab_list(all_note_sequence_tokens, num_merges, save_every_n_merges: int = 500, separator = "|", tokens_dir = "tokens", dedupe: bool = True, workers: int = 1):
     '''
     Generates vocabulary list in batches and saves intermediate results.
 
+    Every merge is appended to tokens_dir/merges.jsonl (flushed every save_every_n_merges);
+    tokens_N.json is only written for the final vocab, use export_vocab for other merge counts.
+
     Args:
     all_note_sequence_tokens: multiple note sequences in one array, separated by separator token
+        (or a corpus.NoteSequenceCorpus, which is read from disk in two streaming passes)
     num_merges: total number of merges to perform
     save_every_n_merges: frequency of saving intermediate results
     separator: token used to separate different note sequences
+    dedupe: train on distinct note sequences weighted by their count (see create_trainer)
+    workers: number of processes to shard training over (see create_trainer)
 
     Returns:
     dict: The final vocabulary list
     '''
-    vocab_list = {char: [char] for char in set(all_note_sequence_tokens)}
+    vocab = Vocab.from_tokens(all_note_sequence_tokens)
     token_count = 1
     freq = {}
 
     # Create tokens directory if it doesn't exist
     os.makedirs(tokens_dir, exist_ok=True)
 
+    # Pair counts are kept live across merges instead of being recounted every merge
+    trainer = create_trainer(vocab, all_note_sequence_tokens, separator, dedupe, workers)
+    merge_log = MergeLog(os.path.join(tokens_dir, MERGE_LOG_FILE))
+
     for merge_count in range(1, num_merges + 1):
-        new_vocab, all_note_sequence_tokens, new_freq = generate_vocab_list(
-            all_note_sequence_tokens, 
-            num_merges = 1, 
-            vocab_list=vocab_list, 
-            separator = separator, 
-            token_count_start = token_count
-        )
-
-        if new_freq == {}: # if no more merges, break
+        best = trainer.most_frequent_pair()
+        if best is None or best[1] == 1: # if no more merges, break
             break
-        vocab_list.update(new_vocab)
-        freq.update(new_freq)
+        most_frequent_pair, count = best
+        new_id = vocab.add_merge(most_frequent_pair, new_token(token_count))
+        freq[new_id] = count
+        trainer.merge(most_frequent_pair, new_id)
         token_count += 1
 
-        if merge_count % save_every_n_merges == 0:
-            save_vocab(vocab_list, freq, merge_count)
+        merge_log.append(vocab, new_id, count)
 
+        if merge_count % save_every_n_merges == 0:
+            merge_log.flush()
+    trainer.close()
+    merge_log.close()
     
     # Save final result
-    save_vocab(vocab_list, freq, token_count - 1)
+    save_vocab(vocab, freq, token_count - 1, tokens_dir)
 
-    return vocab_list
+    return vocab.vocab_list()
 
-def save_vocab(vocab_list, freq, merge_count, tokens_dir = "tokens"):
+def save_vocab(vocab: Vocab, freq, merge_count, tokens_dir = "tokens"):
+    '''
+    Saves every merged token in vocab to tokens_<merge_count>.json.
+    freq maps merged token ids to their frequency; ids are only turned into strings here.
+    "notes" holds the packed note sequence (see packed_sequence.parse_seq) next to the "seq" string.
+    '''
     output = {}
-    for token, expansion in vocab_list.items():
-        if token.startswith('t_'):
-            expanded_tokens = expand_token(token, vocab_list)
-            seq = deserialize(expanded_tokens)
-            output[token] = {
-                "freq": freq.get(token, 1),  # Default to 1 if not found
-                "tokens": str(expansion),
-                "seq": str(seq),
-                "seq_len": len(seq)
-            }
+    chords = {}  # starting token id -> chord, so each chord string is parsed once
+    for token_id, pair in vocab.merges.items():
+        token = vocab.tokens[token_id]
+        expanded_ids = vocab.expand(token_id)
+        for chord_id in expanded_ids:
+            if chord_id not in chords:
+                chords[chord_id] = deserialize([vocab.tokens[chord_id]])[0]
+        seq = [chords[chord_id] for chord_id in expanded_ids]
+        output[token] = {
+            "freq": freq.get(token_id, 1),  # Default to 1 if not found
+            "tokens": str(vocab.decode(pair)),
+            "seq": str(seq),
+            "seq_len": len(seq),
+            "notes": encode_packed(pack_note_sequence(seq))
+        }
 
     filename = f'{tokens_dir}/tokens_{merge_count}.json'
     with open(filename, 'w') as f:
@@ -150,88 +168,309 @@ def save_vocab(vocab_list, freq, merge_count, tokens_dir = "tokens"):
     print(f"Saved vocabulary at {merge_count} merges to {filename}")
 
 
-def batch_generate_vocab_list_progressive(all_note_sequence_tokens: list[str], num_merges, save_every_n_merges: int = 500, separator = "|", tokens_dir = "tokens"):
+MERGE_LOG_FILE = "merges.jsonl"
+
+class MergeLog:
+    '''
+    Append-only log of merges, one JSON object per line in merge order:
+    {"token": "t_12", "tokens": [left, right], "freq": 42}
+
+    Only the new merges are written at each checkpoint, unlike tokens_N.json which holds the
+    whole expanded vocab. keep: number of merges already in the file to keep; anything after
+    them (ie. merges made after the last checkpoint before a crash) is dropped.
+    '''
+    def __init__(self, filename, keep: int = 0):
+        self.filename = filename
+        self.count = 0
+        offset = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                for line in f:
+                    if self.count == keep or not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    self.count += 1
+        self.file = open(filename, 'ab')
+        self.file.truncate(offset)
+
+    def append(self, vocab: Vocab, token_id, freq):
+        record = {"token": vocab.tokens[token_id], "tokens": vocab.decode(vocab.merges[token_id]), "freq": freq}
+        self.file.write(json.dumps(record).encode() + b'\n')
+        self.count += 1
+
+    def reset(self):
+        self.file.truncate(0)
+        self.count = 0
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def read_merge_log(filename, merge_count = None):
+    '''
+    Returns the first merge_count records (all if None) of a merge log as (token, [left, right], freq)
+    '''
+    merges = []
+    with open(filename, 'r') as f:
+        for line in f:
+            # Stop at a partially written last line (ie. a crash mid-append)
+            if (merge_count is not None and len(merges) == merge_count) or not line.endswith('\n'):
+                break
+            record = json.loads(line)
+            merges.append((record['token'], record['tokens'], record['freq']))
+    return merges
+
+def export_vocab(tokens_dir, merge_count = None):
+    '''
+    Writes tokens_<merge_count>.json (the save_vocab format) from the merge log in tokens_dir.
+    merge_count: number of merges to export, defaults to every merge in the log
+
+    Returns:
+    str: path of the exported file
+    '''
+    merges = read_merge_log(os.path.join(tokens_dir, MERGE_LOG_FILE), merge_count)
+    vocab = Vocab()
+    freq = {}
+    for token, (left, right), count in merges:
+        token_id = vocab.add_merge((vocab.intern(left), vocab.intern(right)), token)
+        freq[token_id] = count
+    save_vocab(vocab, freq, len(merges), tokens_dir)
+    return f'{tokens_dir}/tokens_{len(merges)}.json'
+
+def load_merge_ranks(token_file):
+    '''
+    Loads the merge table (pair -> (rank, token)) of a tokens_N.json file for encoding
+    '''
+    with open(token_file, 'r') as f:
+        token_data = json.load(f)
+    vocab_list = {token: ast.literal_eval(data['tokens']) for token, data in token_data.items()}
+    return merge_ranks(vocab_list)
+
+# Per-process encoder state for batch_encode, set up once by _init_encoder
+_encoder_merges = None
+_encode_cached = None
+
+def _init_encoder(merges, cache_size):
+    global _encoder_merges, _encode_cached
+    _encoder_merges = merges
+    _encode_cached = lru_cache(maxsize=cache_size)(_encode_segment)
+
+def _encode_segment(segment: tuple):
+    return encode_tokens(segment, _encoder_merges)
+
+def _encode_note_sequence(note_sequence):
+    return _encode_cached(tuple(serialize(note_sequence)))
+
+def batch_encode(note_sequences, merges, workers: int = None, cache_size: int = 4096, chunksize: int = 64):
+    '''
+    Tokenizes many note sequences with an existing vocabulary, yielding the encoded token
+    lists in input order. note_sequences can be any iterable (ie. a generator reading files),
+    it is streamed through a process pool. Each worker keeps an LRU cache of the sequences it
+    already encoded, so repeated sequences are only encoded once per worker.
+
+    merges: pair -> (rank, token) table from merge_ranks / load_merge_ranks
+    workers: number of processes (default: cpu count), 1 encodes in this process
+    '''
+    if workers == 1:
+        _init_encoder(merges, cache_size)
+        for note_sequence in note_sequences:
+            yield list(_encode_note_sequence(note_sequence))
+        return
+
+    with multiprocessing.Pool(workers, initializer=_init_encoder, initargs=(merges, cache_size)) as pool:
+        for encoded in pool.imap(_encode_note_sequence, note_sequences, chunksize=chunksize):
+            yield list(encoded)
+
+CHECKPOINT_FILE = "checkpoint.npz"
+
+def save_checkpoint(filename, vocab: Vocab, freq, merge_count, trainer, separator = "|"):
+    '''
+    Saves everything needed to continue training after merge_count merges: the starting
+    tokens, the merges in order with their frequencies, and the current merged (deduplicated)
+    corpus with its weights. The file is replaced atomically so a crash mid-write keeps the
+    previous checkpoint.
+    '''
+    tokens, weights = trainer.snapshot()
+    merge_ids = list(vocab.merges)
+    base_tokens = [token for token_id, token in enumerate(vocab.tokens) if token_id not in vocab.merges]
+
+    temp_filename = f"{filename}.tmp.npz"
+    np.savez(
+        temp_filename,
+        base_tokens=np.array(base_tokens, dtype=str),
+        merge_names=np.array([vocab.tokens[token_id] for token_id in merge_ids], dtype=str),
+        merges=np.array([vocab.merges[token_id] for token_id in merge_ids], dtype=np.int32).reshape(-1, 2),
+        freq=np.array([freq.get(token_id, 1) for token_id in merge_ids], dtype=np.int64),
+        merge_count=merge_count,
+        tokens=np.frombuffer(tokens, dtype=np.intc),
+        weights=np.frombuffer(weights, dtype=np.intc),
+        separator=separator
+    )
+    os.replace(temp_filename, filename)
+
+def load_checkpoint(filename):
+    '''
+    Loads a checkpoint written by save_checkpoint
+
+    Returns:
+    tuple: (vocab, freq, merge_count, tokens, weights)
+    '''
+    data = np.load(filename)
+    vocab = Vocab()
+    for token in data['base_tokens']:
+        vocab.intern(str(token))
+    freq = {}
+    for name, pair, count in zip(data['merge_names'], data['merges'], data['freq']):
+        token_id = vocab.add_merge((int(pair[0]), int(pair[1])), str(name))
+        freq[token_id] = int(count)
+    tokens = array('i', data['tokens'].astype(np.intc).tobytes())
+    weights = array('i', data['weights'].astype(np.intc).tobytes())
+    return vocab, freq, int(data['merge_count']), tokens, weights
+
+def replay_merges(vocab: Vocab, trainer, merges):
+    '''
+    Re-applies (token, [left, right], freq) merges in order to a fresh trainer.
+    Used to resume from a merge log or token file when there is no checkpoint.
+
+    Returns:
+    dict: freq of the replayed merges
+    '''
+    freq = {}
+    for token, (left, right), count in merges:
+        pair = (vocab.ids[left], vocab.ids[right])
+        token_id = vocab.add_merge(pair, token)
+        freq[token_id] = count
+        trainer.merge(pair, token_id)
+    return freq
+
+class DeferredInterrupt:
+    '''
+    Postpones Ctrl-C inside the with block: SIGINT only sets interrupted, so the training loop
+    finishes the merge it is applying and stops at the next check. A merge interrupted halfway
+    would otherwise be checkpointed with the vocab and the corpus out of step.
+    '''
+    def __enter__(self):
+        self.interrupted = False
+        try:
+            self.previous_handler = signal.signal(signal.SIGINT, self._handle)
+        except ValueError:
+            # Signal handlers can only be set from the main thread
+            self.previous_handler = None
+        return self
+
+    def _handle(self, signum, frame):
+        if not self.interrupted:
+            print("\nInterrupted. Stopping after the current merge...")
+        self.interrupted = True
+
+    def __exit__(self, *exc_info):
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGINT, self.previous_handler)
+        return False
+
+def batch_generate_vocab_list_progressive(all_note_sequence_tokens, num_merges, save_every_n_merges: int = 500, separator = "|", tokens_dir = "tokens", dedupe: bool = True, workers: int = 1):
     '''
     Generates vocabulary list in batches and saves intermediate results.
     Can resume from the last saved state.
 
+    Every merge is appended to tokens_dir/merges.jsonl. Every save_every_n_merges the log is
+    flushed and a binary checkpoint (tokens_dir/checkpoint.npz) is written. Resuming from it
+    restores the merged corpus directly instead of re-running the merges. Without a
+    checkpoint, the merges of the merge log (or of the latest tokens_N.json) are replayed.
+    tokens_N.json is only written for the final vocab, use export_vocab for other merge counts.
+
     Args:
     all_note_sequence_tokens: multiple note sequences in one array, separated by separator token
+        (or a corpus.NoteSequenceCorpus, which is read from disk in two streaming passes)
     num_merges: total number of merges to perform
     save_every_n_merges: frequency of saving intermediate results
     separator: token used to separate different note sequences
     tokens_dir: directory to save token files
+    dedupe: train on distinct note sequences weighted by their count (see create_trainer)
+    workers: number of processes to shard training over (see create_trainer)
 
     Returns:
     dict: The final vocabulary list
     '''
     # Create tokens directory if it doesn't exist
     os.makedirs(tokens_dir, exist_ok=True)
+    checkpoint_file = os.path.join(tokens_dir, CHECKPOINT_FILE)
+
+    merge_log_file = os.path.join(tokens_dir, MERGE_LOG_FILE)
 
     # Check for the latest saved state
     saved_files = [f for f in os.listdir(tokens_dir) if f.startswith('tokens_') and f.endswith('.json')]
-    if saved_files:
-        latest_file = max(saved_files, key=lambda x: int(x.split('_')[1].split('.')[0]))
-        last_merge_count = int(latest_file.split('_')[1].split('.')[0])
-        
-        print(f"Resuming from merge count {last_merge_count}")
-        
-        # Load the latest state
-        with open(os.path.join(tokens_dir, latest_file), 'r') as f:
-            saved_state = json.load(f)
-        
-        vocab_list = {k: v['tokens'] for k, v in saved_state.items()}
-        freq = {k: v['freq'] for k, v in saved_state.items()}
-        token_count = last_merge_count + 1
+    if os.path.exists(checkpoint_file):
+        vocab, freq, last_merge_count, tokens, weights = load_checkpoint(checkpoint_file)
+        print(f"Resuming from checkpoint at merge count {last_merge_count}")
+        trainer = make_trainer(tokens, vocab.ids.get(separator, -1), weights, workers)
+    elif os.path.exists(merge_log_file) or saved_files:
+        if os.path.exists(merge_log_file):
+            merges = read_merge_log(merge_log_file)
+            print(f"Resuming from merge count {len(merges)} (replaying merges from {MERGE_LOG_FILE})")
+        else:
+            latest_file = max(saved_files, key=lambda x: int(x.split('_')[1].split('.')[0]))
+            print(f"Resuming from merge count {int(latest_file.split('_')[1].split('.')[0])} (replaying merges from {latest_file})")
+
+            # Load the latest state
+            with open(os.path.join(tokens_dir, latest_file), 'r') as f:
+                saved_state = json.load(f)
+            merges = [(token, ast.literal_eval(data['tokens']), data['freq']) for token, data in saved_state.items()]
         
-        # Reconstruct all_note_sequence_tokens
-        all_note_sequence_tokens = reconstruct_tokens(vocab_list, all_note_sequence_tokens)
+        vocab = Vocab.from_tokens(all_note_sequence_tokens)
+        trainer = create_trainer(vocab, all_note_sequence_tokens, separator, dedupe, workers)
+        freq = replay_merges(vocab, trainer, merges)
+        last_merge_count = len(merges)
     else:
         print("Starting from scratch")
-        vocab_list = {char: [char] for char in set(all_note_sequence_tokens)}
+        vocab = Vocab.from_tokens(all_note_sequence_tokens)
+        trainer = create_trainer(vocab, all_note_sequence_tokens, separator, dedupe, workers)
         freq = {}
-        token_count = 1
         last_merge_count = 0
 
-    for merge_count in range(last_merge_count + 1, num_merges + 1):
-        new_vocab, all_note_sequence_tokens, new_freq = generate_vocab_list(
-            all_note_sequence_tokens, 
-            num_merges = 1, 
-            vocab_list=vocab_list, 
-            separator = separator, 
-            token_count_start = token_count
-        )
-
-        if new_freq == {}: # if no more merges, break
-            print(f"No more merges possible. Stopped at merge count {merge_count - 1}")
-            break
-        
-        vocab_list.update(new_vocab)
-        freq.update(new_freq)
-        token_count += 1
-
-        if merge_count % save_every_n_merges == 0:
-            save_vocab(vocab_list, freq, merge_count, tokens_dir)
-            print(f"Saved state at merge count {merge_count}")
-
-    # Save final result
-    save_vocab(vocab_list, freq, token_count - 1, tokens_dir)
-    print(f"Final state saved at merge count {token_count - 1}")
-
-    return vocab_list
-
-def reconstruct_tokens(vocab_list, original_tokens):
-    """
-    Reconstruct the token list based on the vocabulary list and original tokens.
-    This is needed when resuming from a saved state.
-    """
-    reconstructed = []
-    for token in original_tokens:
-        if token in vocab_list:
-            reconstructed.append(token)
-        else:
-            reconstructed.extend(vocab_list[token])
-    return reconstructed
+    # Drop merges logged after the state we resumed from, rewrite the log if it is behind
+    merge_log = MergeLog(merge_log_file, keep=last_merge_count)
+    if merge_log.count < last_merge_count:
+        merge_log.reset()
+        for token_id in vocab.merges:
+            merge_log.append(vocab, token_id, freq.get(token_id, 1))
+    token_count = last_merge_count + 1
+
+    with DeferredInterrupt() as interrupt:
+        try:
+            for merge_count in range(last_merge_count + 1, num_merges + 1):
+                if interrupt.interrupted:
+                    print("Saving progress...")
+                    break
+                best = trainer.most_frequent_pair()
+                if best is None or best[1] == 1: # if no more merges, break
+                    print(f"No more merges possible. Stopped at merge count {merge_count - 1}")
+                    break
+            
+                most_frequent_pair, count = best
+                new_id = vocab.add_merge(most_frequent_pair, new_token(token_count))
+                freq[new_id] = count
+                trainer.merge(most_frequent_pair, new_id)
+                merge_log.append(vocab, new_id, count)
+                token_count += 1
+
+                if merge_count % save_every_n_merges == 0:
+                    merge_log.flush()
+                    save_checkpoint(checkpoint_file, vocab, freq, merge_count, trainer, separator)
+                    print(f"Saved state at merge count {merge_count}")
+        finally:
+            # Save final result
+            merge_log.close()
+            save_checkpoint(checkpoint_file, vocab, freq, token_count - 1, trainer, separator)
+            save_vocab(vocab, freq, token_count - 1, tokens_dir)
+            trainer.close()
+            print(f"Final state saved at merge count {token_count - 1}")
+
+    return vocab.vocab_list()
 
 def main():
     # # Get directory that has all midi files
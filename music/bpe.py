@@ -0,0 +1,351 @@
+from collections import defaultdict
+from functools import partial
+from array import array
+import heapq
+import multiprocessing
+import signal
+import numpy as np
+
+class PairQueue:
+    '''
+    Pair counts with a lazy-deletion max-heap on top, so the most frequent pair can be found
+    without scanning every pair.
+
+    A pair is re-pushed whenever its count changes; heap entries whose count no longer matches
+    are discarded when they reach the top. Ties go to the smallest (left id, right id), which
+    keeps merge order (and t_N numbering) independent of the order the corpus was read in.
+    '''
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.heap = []
+
+    def add(self, pair, delta):
+        self.counts[pair] += delta
+        if self.counts[pair] == 0:
+            del self.counts[pair]
+
+    def push(self, pair):
+        count = self.counts.get(pair)
+        if count:
+            heapq.heappush(self.heap, (-count, pair))
+
+    def top(self):
+        '''
+        Returns (pair, count) for the most frequent pair, or None if there are no pairs
+        '''
+        heap = self.heap
+        # Rebuild once stale entries dominate so the heap does not grow without bound
+        if len(heap) > 2 * len(self.counts) + 1024:
+            self.heap = heap = [(-count, pair) for pair, count in self.counts.items()]
+            heapq.heapify(heap)
+        while heap:
+            neg_count, pair = heap[0]
+            if self.counts.get(pair) == -neg_count:
+                return pair, -neg_count
+            heapq.heappop(heap)
+        return None
+
+def dedupe_sequences(tokens, separator: int = -1):
+    '''
+    Collapses repeated separator-bounded sequences into one copy with a multiplicity count,
+    like the word-frequency table used by text BPE.
+
+    Returns (tokens, weights): the distinct sequences in first-seen order joined by the
+    separator, and the multiplicity of the sequence each position belongs to.
+    '''
+    tokens = tokens if isinstance(tokens, array) and tokens.typecode == 'i' else array('i', tokens)
+    # Sequences are keyed by their raw bytes, 4 bytes per token instead of a tuple of ints
+    ends = np.flatnonzero(np.frombuffer(tokens, dtype=np.intc) == separator).tolist()
+    ends.append(len(tokens))
+    counts = {}
+    start = 0
+    for end in ends:
+        key = tokens[start:end].tobytes()
+        counts[key] = counts.get(key, 0) + 1
+        start = end + 1
+
+    unique_tokens = array('i')
+    weights = array('i')
+    for i, (key, count) in enumerate(counts.items()):
+        if i > 0:
+            unique_tokens.append(separator)
+            weights.append(count)
+        unique_tokens.frombytes(key)
+        weights.extend(array('i', [count]) * (len(key) // unique_tokens.itemsize))
+    return unique_tokens, weights
+
+class BPETrainer:
+    '''
+    Keeps the pair counts of a token id list live while merges are applied, so each merge
+    only touches the neighbors of the merged occurrences instead of rescanning everything.
+
+    Tokens are integer ids (see encoding.Vocab). The token list is stored as a doubly linked
+    list of int arrays over the original positions. A merged token takes the position of its
+    left half, so position order is always token order. Pairs that contain the separator id
+    are never counted (and therefore never merged).
+
+    The positions of each pair are an append-only int array; positions whose pair has since
+    changed are skipped when the pair is merged, so no per-occurrence Python objects are kept.
+
+    weights (optional) gives every position a multiplicity, so a sequence that stands for
+    several identical sequences (see dedupe_sequences) counts its pairs that many times.
+
+    with_queue=False skips the heap for callers that pick merges elsewhere and only need the
+    count deltas merge() returns (see ParallelBPETrainer).
+    '''
+    def __init__(self, tokens, separator: int = -1, weights=None, with_queue: bool = True):
+        self.separator = separator
+        self.symbols = array('i', tokens)
+        n = len(self.symbols)
+        self.weights = array('i', weights) if weights is not None else array('i', [1]) * n
+        self.prev = array('i', range(-1, n - 1))
+        self.next = array('i', range(1, n + 1))
+        if n:
+            self.next[-1] = -1
+
+        self.with_queue = with_queue
+        self.queue = PairQueue()
+        self.counts = self.queue.counts     # pair -> (weighted) number of occurrences
+        self.where = defaultdict(partial(array, 'i'))   # pair -> left positions of its occurrences (may be stale)
+        self.deltas = defaultdict(int)      # pair -> count change since the last flush
+        for i in range(n - 1):
+            self._add(i, self.symbols[i], self.symbols[i + 1])
+        self._flush()
+
+    def _add(self, i, left, right):
+        if left == self.separator or right == self.separator:
+            return
+        pair = (left, right)
+        weight = self.weights[i]
+        self.queue.add(pair, weight)
+        self.where[pair].append(i)
+        self.deltas[pair] += weight
+
+    def _remove(self, i, left, right):
+        if left == self.separator or right == self.separator:
+            return
+        pair = (left, right)
+        weight = self.weights[i]
+        self.queue.add(pair, -weight)
+        if pair not in self.counts:
+            self.where.pop(pair, None)
+        self.deltas[pair] -= weight
+
+    def _flush(self):
+        '''
+        Re-pushes the pairs whose count changed and returns their count deltas
+        '''
+        deltas = {pair: delta for pair, delta in self.deltas.items() if delta}
+        self.deltas.clear()
+        if self.with_queue:
+            for pair in deltas:
+                self.queue.push(pair)
+        return deltas
+
+    def most_frequent_pair(self):
+        '''
+        Returns (pair, count) for the most frequent pair, or None if there are no pairs
+        '''
+        return self.queue.top()
+
+    def merge(self, pair, new_id):
+        '''
+        Replaces every non-overlapping occurrence of pair (left to right) with new_id
+        and updates the counts of the neighboring pairs.
+
+        Returns the count change of every pair the merge touched
+        '''
+        left, right = pair
+        positions = self.where.pop(pair, None)
+        if not positions:
+            return {}
+        symbols, prev, next_ = self.symbols, self.prev, self.next
+
+        for i in np.unique(np.frombuffer(positions, dtype=np.intc)).tolist():
+            j = next_[i]
+            # Skip positions whose pair changed since they were recorded, or that an earlier
+            # merge in this pass consumed (ie. 'a a a')
+            if symbols[i] != left or j == -1 or symbols[j] != right:
+                continue
+            p = prev[i]
+            n = next_[j]
+
+            if p != -1:
+                self._remove(p, symbols[p], left)
+            if n != -1:
+                self._remove(j, right, symbols[n])
+            self._remove(i, left, right)
+
+            symbols[i] = new_id
+            symbols[j] = -1
+            next_[i] = n
+            if n != -1:
+                prev[n] = i
+
+            if p != -1:
+                self._add(p, symbols[p], new_id)
+            if n != -1:
+                self._add(i, new_id, symbols[n])
+
+        return self._flush()
+
+    def tokens(self):
+        '''
+        Returns the current (merged) token id list
+        '''
+        return self.snapshot()[0]
+
+    def snapshot(self):
+        '''
+        Returns (tokens, weights) for the current (merged) token list. A new BPETrainer built
+        from them continues with exactly the same pair counts and merges.
+        '''
+        tokens = array('i')
+        weights = array('i')
+        i = 0 if self.symbols else -1
+        while i != -1:
+            tokens.append(self.symbols[i])
+            weights.append(self.weights[i])
+            i = self.next[i]
+        return tokens, weights
+
+    def close(self):
+        # Nothing to release, kept so BPETrainer and ParallelBPETrainer are interchangeable
+        pass
+
+def split_shards(tokens, separator: int, num_shards: int, weights=None):
+    '''
+    Splits a separator-delimited corpus into at most num_shards pieces of roughly equal
+    length, cutting only at separators (the separator at each cut is dropped).
+
+    Returns a list of (tokens, weights) tuples
+    '''
+    tokens = array('i', tokens)
+    weights = array('i', weights) if weights is not None else array('i', [1]) * len(tokens)
+    target = max(1, len(tokens) // max(1, num_shards))
+    shards = []
+    start = 0
+    for i, token in enumerate(tokens):
+        if token == separator and i - start >= target and len(shards) < num_shards - 1:
+            shards.append((tokens[start:i], weights[start:i]))
+            start = i + 1
+    shards.append((tokens[start:], weights[start:]))
+    return shards
+
+def _shard_worker(conn, tokens, weights, separator):
+    '''
+    Owns one shard of the corpus: reports its pair counts, then applies every merge the
+    coordinator sends and replies with the resulting count deltas.
+    '''
+    # Ctrl-C is handled by the coordinator, which still needs the shards to save its state
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    trainer = BPETrainer(tokens, separator, weights, with_queue=False)
+    conn.send(dict(trainer.counts))
+    while True:
+        message = conn.recv()
+        if message[0] == 'merge':
+            _, pair, new_id = message
+            conn.send(trainer.merge(pair, new_id))
+        elif message[0] == 'snapshot':
+            conn.send(trainer.snapshot())
+        else:
+            break
+    conn.close()
+
+class ParallelBPETrainer:
+    '''
+    BPETrainer spread over a pool of worker processes. The corpus is split into shards at
+    separators; each worker keeps its shard's pair counts and applies every merge locally,
+    and this coordinator sums their count deltas into one PairQueue to pick the next merge.
+
+    Pairs never cross a separator, so the summed counts (and therefore the merges and their
+    tie-breaks) are exactly those of the serial BPETrainer.
+    '''
+    def __init__(self, tokens, separator: int = -1, weights=None, workers: int = None):
+        workers = workers or multiprocessing.cpu_count()
+        self.separator = separator
+        self.queue = PairQueue()
+        self.counts = self.queue.counts
+        self.connections = []
+        self.processes = []
+        for shard_tokens, shard_weights in split_shards(tokens, separator, workers, weights):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child_conn, shard_tokens, shard_weights, separator), daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+
+        for conn in self.connections:
+            self._apply(conn.recv())
+
+    def _apply(self, deltas):
+        for pair, delta in deltas.items():
+            self.queue.add(pair, delta)
+        for pair in deltas:
+            self.queue.push(pair)
+
+    def most_frequent_pair(self):
+        '''
+        Returns (pair, count) for the most frequent pair, or None if there are no pairs
+        '''
+        return self.queue.top()
+
+    def merge(self, pair, new_id):
+        '''
+        Applies the merge on every shard and returns the summed count deltas
+        '''
+        for conn in self.connections:
+            conn.send(('merge', pair, new_id))
+        total = defaultdict(int)
+        for conn in self.connections:
+            for changed_pair, delta in conn.recv().items():
+                total[changed_pair] += delta
+        deltas = {changed_pair: delta for changed_pair, delta in total.items() if delta}
+        self._apply(deltas)
+        return deltas
+
+    def tokens(self):
+        '''
+        Returns the current (merged) token id list, shards joined by the separator
+        '''
+        return self.snapshot()[0]
+
+    def snapshot(self):
+        '''
+        Returns (tokens, weights) for the current (merged) token list, shards joined by the separator
+        '''
+        tokens = array('i')
+        weights = array('i')
+        for i, conn in enumerate(self.connections):
+            conn.send(('snapshot',))
+            if i > 0:
+                tokens.append(self.separator)
+                weights.append(1)
+            shard_tokens, shard_weights = conn.recv()
+            tokens.extend(shard_tokens)
+            weights.extend(shard_weights)
+        return tokens, weights
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(('close',))
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def make_trainer(tokens, separator: int = -1, weights=None, workers: int = 1):
+    '''
+    Returns a ParallelBPETrainer when workers > 1, otherwise a BPETrainer
+    '''
+    if workers > 1:
+        return ParallelBPETrainer(tokens, separator, weights, workers=workers)
+    return BPETrainer(tokens, separator, weights)
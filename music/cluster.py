@@ -6,6 +6,7 @@ from sklearn.manifold import MDS
 import matplotlib.pyplot as plt
 import os
 from midi_similarity import compare_midi_sequences
+from packed_sequence import parse_seq
 
 def load_tokens(json_file):
     with open(json_file, 'r') as f:
@@ -16,10 +17,10 @@ def create_similarity_matrix(tokens):
     similarity_matrix = np.zeros((n, n))
     
     for i, (token1, data1) in enumerate(tokens.items()):
-        seq1 = eval(data1['seq'])
+        seq1 = parse_seq(data1)
         for j, (token2, data2) in enumerate(tokens.items()):
             if i < j:
-                seq2 = eval(data2['seq'])
+                seq2 = parse_seq(data2)
                 similarity = compare_midi_sequences(seq1, seq2)
                 similarity_matrix[i, j] = similarity_matrix[j, i] = similarity
             elif i == j:
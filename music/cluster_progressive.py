@@ -2,72 +2,258 @@ import json
 import numpy as np
 from scipy.cluster.hierarchy import dendrogram, linkage, fcluster
 from scipy.spatial.distance import squareform
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 import os
 import time
-from midi_similarity import compare_midi_sequences
+import multiprocessing
+from midi_similarity import sequence_note_arrays, piano_roll, unpack_piano_roll, batch_structure_similarity
+from packed_sequence import parse_seq
 
 def load_tokens(json_file):
     with open(json_file, 'r') as f:
         return json.load(f)
 
-def create_similarity_matrix(tokens, similarity_file, checkpoint_interval=100):
+def rasterize_tokens(tokens, token_list, target_width=100, packed=False):
+    '''
+    Parses and rasterizes every token's note sequence once (see midi_similarity.piano_roll).
+
+    packed: store the rolls with np.packbits (8 columns per byte, see unpack_piano_roll). The
+    stack takes n * max height * ceil(target_width / 8) bytes instead of n * max height *
+    target_width, ie. about 0.5 GB instead of 4 GB for 10^6 tokens of up to 40 pitches.
+
+    Returns:
+    tuple: (rolls, heights) where rolls is an (n, max height, target_width) uint8 stack (last axis
+    packed if packed), each roll zero-padded at the bottom, and heights holds each roll's own
+    height. rolls[i, :h] with h = max(heights[i], heights[j]) is exactly the image
+    compare_midi_sequences builds for token i when comparing it with token j.
+    '''
+    token_rolls = [piano_roll(*sequence_note_arrays(parse_seq(tokens[token])), width=target_width, packed=packed) for token in token_list]
+    heights = np.array([len(roll) for roll in token_rolls], dtype=np.int64)
+    row_width = (target_width + 7) // 8 if packed else target_width
+    rolls = np.zeros((len(token_list), int(heights.max()) if len(heights) else 0, row_width), dtype=np.uint8)
+    for i, roll in enumerate(token_rolls):
+        rolls[i, :heights[i]] = roll
+    return rolls, heights
+
+# Similarity scores are stored in single precision, half the size of float64
+SIMILARITY_DTYPE = np.float32
+
+def matrix_file_name(similarity_file):
+    '''
+    The similarity matrix itself is a memory-mapped .npy next to similarity_file, which holds
+    the token list and the number of completed rows
+    '''
+    return os.path.splitext(similarity_file)[0] + '.npy'
+
+def condensed_size(n):
+    '''
+    Number of cells of the condensed upper triangle (without the diagonal) of an n x n matrix
+    '''
+    return n * (n - 1) // 2
+
+def row_offset(i, n):
+    '''
+    Index of cell (i, i + 1) in the condensed upper triangle (scipy's squareform order), so
+    cell (i, j) with i < j is at row_offset(i, n) + j - i - 1 and each row is contiguous
+    '''
+    return i * n - i * (i + 1) // 2
+
+def condense_similarity_matrix(similarity_matrix):
+    '''
+    Condensed upper triangle of a square similarity matrix (the diagonal, always 1, is dropped)
+    '''
+    return squareform(np.asarray(similarity_matrix), checks=False).astype(SIMILARITY_DTYPE)
+
+def square_similarity_matrix(condensed):
+    '''
+    Full n x n similarity matrix of a condensed one, with 1 on the diagonal
+    '''
+    similarity_matrix = squareform(np.asarray(condensed, dtype=np.float64), checks=False)
+    np.fill_diagonal(similarity_matrix, 1.0)
+    return similarity_matrix
+
+# Per-process state of the similarity workers (set by _init_similarity_worker)
+_rolls = None
+_heights = None
+_matrix = None
+_width = None
+
+def _init_similarity_worker(rolls_file, heights, matrix_file, width):
+    global _rolls, _heights, _matrix, _width
+    _rolls = np.load(rolls_file, mmap_mode='r')
+    _heights = heights
+    _matrix = np.load(matrix_file, mmap_mode='r+')
+    _width = width
+
+def _similarity_tile(tile):
+    '''
+    Fills the upper-triangle cells of rows [row_start, row_end) x columns [col_start, col_end)
+    of the shared condensed matrix
+    '''
+    row_start, row_end, col_start, col_end = tile
+    n = len(_heights)
+    # The stored rolls are packed, only this tile's rows and columns are unpacked
+    rows = unpack_piano_roll(_rolls[row_start:row_end], _width)
+    columns = unpack_piano_roll(_rolls[col_start:col_end], _width)
+    for i in range(row_start, row_end):
+        first_column = max(col_start, i + 1)
+        if first_column >= col_end:
+            continue
+        scores = batch_structure_similarity(rows[i - row_start], columns[first_column - col_start:], _heights[i], _heights[first_column:col_end])
+        start = row_offset(i, n) + first_column - i - 1
+        _matrix[start:start + col_end - first_column] = scores
+    _matrix.flush()
+    return tile
+
+def row_block_tiles(row_start, row_end, n, tile_size):
+    '''
+    Splits the upper triangle of rows [row_start, row_end) into column tiles of tile_size
+    '''
+    return [(row_start, row_end, col_start, min(col_start + tile_size, n)) for col_start in range(row_start + 1, n, tile_size)]
+
+def create_similarity_matrix(tokens, similarity_file, checkpoint_interval=100, workers=None, tile_size=256, target_width=100):
+    '''
+    Computes the similarity (compare_midi_sequences) of every pair of tokens.
+
+    Every token is parsed and rasterized once. Rows are processed in blocks of checkpoint_interval
+    rows; each block's upper triangle is split into column tiles that a pool of workers processes
+    in parallel, writing straight into a memory-mapped matrix (see matrix_file_name). After each
+    block the completed row count is saved, so an interrupted run resumes from the last block.
+
+    The matrix is stored condensed: only the upper triangle, as n * (n - 1) / 2 float32 values in
+    scipy's squareform order (see row_offset), so it takes an eighth of the dense float64 matrix
+    and cluster_tokens can pass it to linkage as is. square_similarity_matrix expands it.
+
+    workers: number of processes (default: all cores), 1 computes in this process
+
+    Returns:
+    numpy.memmap: the condensed similarity matrix
+    '''
     n = len(tokens)
     token_list = list(tokens.keys())
-    
+    workers = workers or multiprocessing.cpu_count()
+    matrix_file = matrix_file_name(similarity_file)
+
     # Check if there's a partial similarity matrix
+    completed_rows = 0
     if os.path.exists(similarity_file):
         print("Loading partial similarity matrix...")
         data = np.load(similarity_file)
-        similarity_matrix = data['similarity_matrix']
-        completed_rows = data['completed_rows']
-        start_row = completed_rows
-    else:
-        similarity_matrix = np.zeros((n, n))
-        start_row = 0
+        completed_rows = int(data['completed_rows'])
+        if 'similarity_matrix' in data.files:
+            # Older checkpoints hold the matrix itself
+            np.save(matrix_file, condense_similarity_matrix(data['similarity_matrix']))
+        elif os.path.exists(matrix_file) and np.load(matrix_file, mmap_mode='r').ndim == 2:
+            # Older matrix files hold the full square matrix
+            np.save(matrix_file, condense_similarity_matrix(np.load(matrix_file, mmap_mode='r')))
+    if not os.path.exists(matrix_file) or np.load(matrix_file, mmap_mode='r').shape != (condensed_size(n),):
+        np.lib.format.open_memmap(matrix_file, mode='w+', dtype=SIMILARITY_DTYPE, shape=(condensed_size(n),)).flush()
         completed_rows = 0
+    start_row = completed_rows
 
     print(f"Starting from row {start_row}")
-    
+
+    rolls, heights = rasterize_tokens(tokens, token_list, target_width, packed=True)
+    rolls_file = os.path.splitext(similarity_file)[0] + '_rolls.npy'
+    np.save(rolls_file, rolls)
+    del rolls
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_similarity_worker, initargs=(rolls_file, heights, matrix_file, target_width))
+        run_tiles = lambda tiles: pool.imap_unordered(_similarity_tile, tiles)
+    else:
+        pool = None
+        _init_similarity_worker(rolls_file, heights, matrix_file, target_width)
+        run_tiles = lambda tiles: map(_similarity_tile, tiles)
+    similarity_matrix = np.load(matrix_file, mmap_mode='r+')
+
     try:
-        for i in range(start_row, n):
-            seq1 = eval(tokens[token_list[i]]['seq'])
-            for j in range(i+1, n):
-                seq2 = eval(tokens[token_list[j]]['seq'])
-                similarity = compare_midi_sequences(seq1, seq2)
-                similarity_matrix[i, j] = similarity_matrix[j, i] = similarity
-            
-            similarity_matrix[i, i] = 1.0  # Self-similarity is 1
-            completed_rows = i + 1
-            
-            if (i + 1) % checkpoint_interval == 0:
-                save_similarity_matrix(similarity_matrix, token_list, similarity_file, completed_rows)
-                print(f"Checkpoint saved at row {i+1}/{n}")
-            
+        for block_start in range(start_row, n, checkpoint_interval):
+            block_end = min(block_start + checkpoint_interval, n)
+            for _ in run_tiles(row_block_tiles(block_start, block_end, n, tile_size)):
+                pass
+
+            similarity_matrix.flush()
+            completed_rows = block_end
+
+            save_similarity_matrix(None, token_list, similarity_file, completed_rows)
+            print(f"Checkpoint saved at row {completed_rows}/{n}")
+
     except KeyboardInterrupt:
         print("\nInterrupted. Saving progress...")
     finally:
-        save_similarity_matrix(similarity_matrix, token_list, similarity_file, completed_rows)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        similarity_matrix.flush()
+        save_similarity_matrix(None, token_list, similarity_file, completed_rows)
+        os.remove(rolls_file)
         print(f"Progress saved. Completed {completed_rows}/{n} rows.")
-    
+
     return similarity_matrix
 
 def save_similarity_matrix(similarity_matrix, tokens, filename, completed_rows):
-    np.savez(filename, similarity_matrix=similarity_matrix, tokens=tokens, completed_rows=completed_rows)
+    '''
+    Saves the token list and completed row count to filename. similarity_matrix (condensed or
+    square) is written to the condensed matrix file unless it is None (already written in place)
+    '''
+    if similarity_matrix is not None:
+        if np.ndim(similarity_matrix) == 2:
+            similarity_matrix = condense_similarity_matrix(similarity_matrix)
+        np.save(matrix_file_name(filename), similarity_matrix)
+    np.savez(filename, tokens=tokens, completed_rows=completed_rows)
 
 def load_similarity_matrix(filename):
+    '''
+    Returns:
+    tuple: (similarity_matrix, tokens, completed_rows). similarity_matrix is the memory-mapped
+    condensed matrix, or the square matrix of files written before it was condensed
+    '''
     data = np.load(filename)
-    return data['similarity_matrix'], data['tokens'], data['completed_rows']
+    if 'similarity_matrix' in data.files:
+        similarity_matrix = data['similarity_matrix']
+    else:
+        similarity_matrix = np.load(matrix_file_name(filename), mmap_mode='r')
+    return similarity_matrix, data['tokens'], data['completed_rows']
 
 def cluster_tokens(similarity_matrix, distance_threshold=0.5):
-    distance_matrix = 1 - similarity_matrix
-    linkage_matrix = linkage(squareform(distance_matrix), method='average')
+    '''
+    Average-linkage clustering of the tokens. similarity_matrix is the condensed matrix of
+    create_similarity_matrix (used as is) or a square matrix
+    '''
+    if np.ndim(similarity_matrix) == 2:
+        similarity_matrix = squareform(np.asarray(similarity_matrix), checks=False)
+    distances = np.subtract(1, similarity_matrix, dtype=np.float64)
+    linkage_matrix = linkage(distances, method='average')
     clusters = fcluster(linkage_matrix, t=distance_threshold, criterion='distance')
     return clusters
 
+def cluster_similarity_graph(graph, distance_threshold=0.5):
+    '''
+    Clusters the tokens of a sparse similarity graph (see token_index.knn_graph) without ever
+    building the dense matrix: the clusters are the connected components of the graph keeping
+    only edges with distance (1 - similarity) at most distance_threshold. This is single linkage
+    cut at distance_threshold over the graph's edges, in O(n + edges) time and memory.
+
+    Returns:
+    numpy.ndarray: cluster ids starting at 1 like cluster_tokens, numbered in token order
+    '''
+    graph = csr_matrix(graph)
+    close = (1 - graph.data.astype(np.float64)) <= distance_threshold
+    graph = csr_matrix((close.astype(np.int8), graph.indices, graph.indptr), shape=graph.shape)
+    graph.eliminate_zeros()
+    _, labels = connected_components(graph, directed=False)
+    return labels + 1
+
 def create_abstracted_tokens(tokens, clusters):
     abstracted_tokens = {}
-    for cluster_id in np.unique(clusters):
-        cluster_tokens = [list(tokens.keys())[i] for i, c in enumerate(clusters) if c == cluster_id]
+    token_list = list(tokens.keys())
+    clusters = np.asarray(clusters)
+    order = np.argsort(clusters, kind='stable')
+    cluster_ids, starts = np.unique(clusters[order], return_index=True)
+    for cluster_id, members in zip(cluster_ids, np.split(order, starts[1:])):
+        cluster_tokens = [token_list[i] for i in members]
         collective_freq = sum(tokens[t]['freq'] for t in cluster_tokens)
         abstracted_tokens[f"r_{cluster_id}"] = {
             "collective_freq": collective_freq,
@@ -1,16 +1,20 @@
 import os
 import shutil
 import argparse
+from preprocess_cache import file_hash
 
 '''
-Usage: python copy_midi_files.py /path/to/source/directory /path/to/destination/directory
+Usage: python copy_midi_files.py /path/to/source/directory /path/to/destination/directory [--skip-duplicate-content]
 
 Finds all midi files in sub directory and copies them to the root of a new directory
 '''
 
-def copy_midi_files(source_dir, destination_dir):
+def copy_midi_files(source_dir, destination_dir, skip_duplicate_content: bool = False):
     '''
     Finds all midi files in sub directory and copies them to the root of a new directory
+
+    skip_duplicate_content: also skip files whose content is identical to a file already in the
+        destination, even if the name differs
     '''
     # Create the destination directory if it doesn't exist
     if not os.path.exists(destination_dir):
@@ -19,6 +23,13 @@ def copy_midi_files(source_dir, destination_dir):
     # Counter for skipped files
     skipped_files = 0
 
+    # Content hashes of the midi files already in the destination
+    hashes = set()
+    if skip_duplicate_content:
+        for file in os.listdir(destination_dir):
+            if file.lower().endswith(('.mid', '.midi')):
+                hashes.add(file_hash(os.path.join(destination_dir, file)))
+
     # Walk through the source directory
     for root, dirs, files in os.walk(source_dir):
         for file in files:
@@ -32,6 +43,13 @@ def copy_midi_files(source_dir, destination_dir):
                     skipped_files += 1
                 else:
                     try:
+                        if skip_duplicate_content:
+                            digest = file_hash(source_path)
+                            if digest in hashes:
+                                print(f"Skipping duplicate content: {file}")
+                                skipped_files += 1
+                                continue
+                            hashes.add(digest)
                         shutil.copy2(source_path, destination_path)
                         print(f"Copied: {file}")
                     except Exception as e:
@@ -44,6 +62,7 @@ def main():
     parser = argparse.ArgumentParser(description="Copy MIDI files from source to destination directory.")
     parser.add_argument("source", help="Source directory containing MIDI files")
     parser.add_argument("destination", help="Destination directory for copied MIDI files")
+    parser.add_argument("--skip-duplicate-content", action="store_true", help="Skip files identical to one already copied")
     args = parser.parse_args()
 
     source_dir = args.source
@@ -54,7 +73,7 @@ def main():
         return
 
     print(f"Copying MIDI files from {source_dir} to {destination_dir}")
-    skipped_files = copy_midi_files(source_dir, destination_dir)
+    skipped_files = copy_midi_files(source_dir, destination_dir, skip_duplicate_content=args.skip_duplicate_content)
 
     print(f"\nCopy operation completed.")
     print(f"Skipped files due to duplicates or errors: {skipped_files}")
@@ -0,0 +1,113 @@
+import os
+import argparse
+import json
+import ast
+from collections import Counter
+from encoding import serialize
+from packed_sequence import chord_strings, load_packed_sequence, pack_processed_midi
+
+'''
+Usage: python3 corpus.py /path/to/preprocessed/midi/directory [--pack]
+
+Streams the note sequences of a preprocessed midi directory from disk, one song at a time,
+and prints corpus statistics. --pack first writes the packed _seq.npy of songs preprocessed
+before it existed, so they are read without parsing the _seq.json.
+'''
+
+def seq_files(processed_midi_dir):
+    '''
+    Yields the path of the *_seq.json file of every midi folder in processed_midi_dir
+    '''
+    for midi_folder in os.listdir(processed_midi_dir):
+        folder_path = os.path.join(processed_midi_dir, midi_folder)
+        if os.path.isdir(folder_path):
+            seq_file = next((f for f in os.listdir(folder_path) if f.endswith('_seq.json')), None)
+            if seq_file:
+                yield os.path.join(folder_path, seq_file)
+
+def read_serialized_sequence(seq_file_path) -> list[str]:
+    '''
+    Returns the serialized chord tokens of one song, from the packed _seq.npy when it exists
+    '''
+    packed_file_path = seq_file_path[:-len('.json')] + '.npy'
+    if os.path.exists(packed_file_path):
+        # Serialize straight from the memory-mapped packed note sequence
+        return chord_strings(load_packed_sequence(packed_file_path))
+    with open(seq_file_path, 'r') as f:
+        note_sequence = ast.literal_eval(json.load(f)['seq'])
+    return serialize(note_sequence)
+
+class NoteSequenceCorpus:
+    '''
+    All note sequences of a preprocessed midi directory as one token stream with separators
+    between sequences, like create_all_note_sequence_tokens, but read lazily from disk.
+
+    Only one song is held in memory at a time, and the corpus can be iterated any number of
+    times (ie. once to build the Vocab and once to encode it for the BPE trainer).
+    '''
+    def __init__(self, processed_midi_dir, separator = "|"):
+        self.processed_midi_dir = processed_midi_dir
+        self.separator = separator
+
+    def sequences(self):
+        '''
+        Yields the serialized chord tokens of each song
+        '''
+        for seq_file_path in seq_files(self.processed_midi_dir):
+            yield read_serialized_sequence(seq_file_path)
+
+    def __iter__(self):
+        first = True
+        for sequence in self.sequences():
+            if not first:
+                yield self.separator
+            first = False
+            yield from sequence
+
+def corpus_stats(corpus: NoteSequenceCorpus, top: int = 10) -> dict:
+    '''
+    Counts songs, chord tokens and distinct chords in one streaming pass.
+    Memory grows with the number of distinct chords, not with the corpus size.
+    '''
+    chord_counts = Counter()
+    song_count = 0
+    token_count = 0
+    longest = 0
+    for sequence in corpus.sequences():
+        chord_counts.update(sequence)
+        song_count += 1
+        token_count += len(sequence)
+        longest = max(longest, len(sequence))
+    return {
+        "songs": song_count,
+        "tokens": token_count,
+        "distinct_chords": len(chord_counts),
+        "longest_song": longest,
+        "most_common": chord_counts.most_common(top),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints statistics of a preprocessed midi directory")
+    parser.add_argument("preprocessed_dir", help="/path/to/preprocessed/midi/directory")
+    parser.add_argument("--pack", action="store_true", help="Write the packed _seq.npy of songs that only have a _seq.json")
+    args = parser.parse_args()
+
+    preprocessed_dir = args.preprocessed_dir
+    if not os.path.isdir(preprocessed_dir):
+        print(f"Error: Preprocessed directory '{preprocessed_dir}' does not exist.")
+        raise SystemExit(1)
+
+    if args.pack:
+        print(f"Packed {pack_processed_midi(preprocessed_dir)} note sequences")
+
+    stats = corpus_stats(NoteSequenceCorpus(preprocessed_dir))
+    print(f"Songs: {stats['songs']}")
+    print(f"Chord tokens: {stats['tokens']}")
+    print(f"Distinct chords: {stats['distinct_chords']}")
+    print(f"Longest song: {stats['longest_song']} chords")
+    print("Most common chords:")
+    for chord, count in stats['most_common']:
+        print(f"  {count:>8}  {chord}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 from collections import defaultdict
+from array import array
 import ast
+import heapq
 from dataclasses import dataclass
+from bpe import BPETrainer
 
 def serialize(note_sequence: list[list[str]]) -> list[str]:
     '''
@@ -17,18 +20,114 @@ def deserialize(note_sequence_tokens: list[str]) -> list[list[str]]:
     '''
     de_ser = []
     for token in note_sequence_tokens:
-        # Use ast.literal_eval to safely convert the string representation of a list back into a list
-        chord = ast.literal_eval(token)
-        # Ensure that each element in the chord is a string
-        chord = [str(note) for note in chord]
+        if token.startswith("['") and token.endswith("']") and '"' not in token:
+            # Tokens made by serialize: split the notes out directly instead of parsing
+            chord = token[2:-2].split("', '")
+        else:
+            # Use ast.literal_eval to safely convert the string representation of a list back into a list
+            chord = ast.literal_eval(token)
+            # Ensure that each element in the chord is a string
+            chord = [str(note) for note in chord]
         de_ser.append(chord)
     return de_ser
 
 def new_token(token_count):
     return f't_{token_count}'
 
+class Expansions:
+    '''
+    Expansions of every vocab id into starting-token ids, computed once bottom-up in merge
+    order and stored as one flat id array plus offsets: id k expands to
+    flat[offsets[k]:offsets[k + 1]]. A merge only refers to earlier ids, so each new id is
+    the concatenation of two ranges that already exist.
+    '''
+    def __init__(self):
+        self.flat = array('i')
+        self.offsets = array('q', [0])
+
+    def update(self, vocab):
+        '''
+        Computes the expansions of the ids added to vocab since the last update
+        '''
+        flat, offsets = self.flat, self.offsets
+        for token_id in range(len(offsets) - 1, len(vocab)):
+            pair = vocab.merges.get(token_id)
+            if pair is None:
+                flat.append(token_id)
+            else:
+                for part in pair:
+                    flat.extend(flat[offsets[part]:offsets[part + 1]])
+            offsets.append(len(flat))
+
+    def expand(self, token_id: int) -> array:
+        return self.flat[self.offsets[token_id]:self.offsets[token_id + 1]]
+
+class Vocab:
+    '''
+    Interned vocabulary: maps every token string (chords, separator and t_N merges) to a
+    dense integer id so BPE can work on small ints instead of long chord strings.
+
+    Starting tokens get ids in sorted order and merges get the next free id, so ids double
+    as the deterministic tie-break rank used by BPETrainer.
+    '''
+    def __init__(self):
+        self.tokens: list[str] = []           # id -> token string
+        self.ids: dict[str, int] = {}         # token string -> id
+        self.merges: dict[int, tuple] = {}    # merged id -> (left id, right id)
+        self.expansions = Expansions()
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        vocab = cls()
+        for token in sorted(set(tokens)):
+            vocab.intern(token)
+        return vocab
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def intern(self, token: str) -> int:
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    def add_merge(self, pair, token: str) -> int:
+        token_id = self.intern(token)
+        self.merges[token_id] = tuple(pair)
+        return token_id
+
+    def encode(self, tokens) -> array:
+        # tokens can be any iterable (ie. a streamed corpus), no intermediate list is built
+        return array('i', map(self.ids.__getitem__, tokens))
+
+    def decode(self, ids) -> list[str]:
+        return [self.tokens[token_id] for token_id in ids]
+
+    def expand(self, token_id: int) -> array:
+        '''
+        Expands a (possibly merged) id into the ids of the starting tokens it covers
+        '''
+        self.expansions.update(self)
+        return self.expansions.expand(token_id)
+
+    def vocab_list(self) -> dict[str, list[str]]:
+        '''
+        Returns the vocab in the string vocab_list form ({token: [token]} or {t_N: [left, right]})
+        '''
+        return {
+            token: self.decode(self.merges[token_id]) if token_id in self.merges else [token]
+            for token_id, token in enumerate(self.tokens)
+        }
+
 def replace_pair(tokens, pair, new_token):
-    result = []
+    '''
+    Replaces non-overlapping occurrences of pair, left to right. Works on token strings or
+    ids; an array of ids is returned as an array.
+    '''
+    result = array(tokens.typecode) if isinstance(tokens, array) else []
     i = 0
     while i < len(tokens) - 1:
         if tokens[i] == pair[0] and tokens[i+1] == pair[1]:
@@ -61,35 +160,134 @@ def generate_vocab_list(note_sequence_tokens: list[str], num_merges, vocab_list
     '''
     if vocab_list == None:
         vocab_list = {char: [char] for char in set(note_sequence_tokens)}
-    tokens = note_sequence_tokens
+    vocab = Vocab.from_tokens(note_sequence_tokens)
+    trainer = BPETrainer(vocab.encode(note_sequence_tokens), vocab.ids.get(separator, -1))
     token_count = token_count_start
     tok_freq = {}
     
     for _ in range(num_merges):
-        freq = pair_frequency(tokens, separator)
-        if not freq:
+        best = trainer.most_frequent_pair()
+        if best is None:
             break
-        most_frequent_pair = max(freq, key=freq.get)
+        most_frequent_pair, count = best
         # if no more frequent pairs, break
-        if freq[most_frequent_pair] == 1: 
+        if count == 1: 
             break
         new_tok = new_token(token_count)
         token_count += 1
-        vocab_list[new_tok] = list(most_frequent_pair)
-        tok_freq[new_tok] = freq[most_frequent_pair]
-        tokens = replace_pair(tokens, most_frequent_pair, new_tok)
-    return vocab_list, tokens, tok_freq
-
-def expand_token(token, vocab_list):
-    if len(vocab_list[token]) == 1:
-        return vocab_list[token]
-    else:
-        return expand_token(vocab_list[token][0], vocab_list) + expand_token(vocab_list[token][1], vocab_list)
+        new_id = vocab.add_merge(most_frequent_pair, new_tok)
+        vocab_list[new_tok] = vocab.decode(most_frequent_pair)
+        tok_freq[new_tok] = count
+        trainer.merge(most_frequent_pair, new_id)
+    return vocab_list, vocab.decode(trainer.tokens()), tok_freq
+
+def merge_ranks(vocab_list) -> dict[tuple[str, str], tuple[int, str]]:
+    '''
+    Given a vocab_list (in merge order, as returned by generate_vocab_list), map every merged
+    pair to (rank, token), where rank is the order the merge was learned in.
+    '''
+    ranks = {}
+    for token, expansion in vocab_list.items():
+        if len(expansion) == 2:
+            ranks[tuple(expansion)] = (len(ranks), token)
+    return ranks
+
+def encode_tokens(tokens: list[str], merges) -> list[str]:
+    '''
+    Applies trained merges to a token list, lowest rank first. Gives the same result as
+    replaying every merge in order, in O(n log n).
+
+    merges: pair -> (rank, token) table from merge_ranks
+    '''
+    symbols = list(tokens)
+    n = len(symbols)
+    prev = list(range(-1, n - 1))
+    next_ = list(range(1, n + 1))
+    if n:
+        next_[-1] = -1
+
+    heap = []
+    for i in range(n - 1):
+        merge = merges.get((symbols[i], symbols[i + 1]))
+        if merge:
+            heap.append((merge[0], i))
+    heapq.heapify(heap)
+
+    while heap:
+        rank, i = heapq.heappop(heap)
+        j = next_[i]
+        # Skip entries whose pair was already consumed or changed by an earlier merge
+        if symbols[i] is None or j == -1:
+            continue
+        merge = merges.get((symbols[i], symbols[j]))
+        if merge is None or merge[0] != rank:
+            continue
+
+        symbols[i] = merge[1]
+        symbols[j] = None
+        n_ = next_[j]
+        next_[i] = n_
+        if n_ != -1:
+            prev[n_] = i
+
+        p = prev[i]
+        if p != -1:
+            merge = merges.get((symbols[p], symbols[i]))
+            if merge:
+                heapq.heappush(heap, (merge[0], p))
+        if n_ != -1:
+            merge = merges.get((symbols[i], symbols[n_]))
+            if merge:
+                heapq.heappush(heap, (merge[0], i))
+
+    result = []
+    i = 0 if n else -1
+    while i != -1:
+        result.append(symbols[i])
+        i = next_[i]
+    return result
+
+def encode(note_sequence: list[list[str]], merges) -> list[str]:
+    '''
+    Tokenizes a new note sequence with an existing vocabulary (ie. [t_12, t_3, "['n_r_4']"])
+
+    merges: pair -> (rank, token) table from merge_ranks
+    '''
+    return encode_tokens(serialize(note_sequence), merges)
+
+def expand_token(token, vocab_list, cache = None):
+    '''
+    Expands a token into the starting tokens it covers, without recursion.
+
+    cache: optional dict shared between calls, so tokens that were already expanded
+    (ie. the halves of later merges) are not expanded again
+    '''
+    if cache is None:
+        cache = {}
+    stack = [token]
+    while stack:
+        current = stack[-1]
+        if current in cache:
+            stack.pop()
+            continue
+        parts = vocab_list[current]
+        if len(parts) == 1:
+            cache[current] = parts
+            stack.pop()
+            continue
+        missing = [part for part in parts if part not in cache]
+        if missing:
+            stack.extend(missing)
+            continue
+        cache[current] = cache[parts[0]] + cache[parts[1]]
+        stack.pop()
+    return list(cache[token])
         
 def detokenize(vocab_list, sort = True):
     expanded_tokens = set()
+    cache = {}
     for token in vocab_list:
-        expanded = ','.join(expand_token(token, vocab_list))
+        expanded = ','.join(expand_token(token, vocab_list, cache))
         expanded_tokens.add(expanded)
     
     if sort:
@@ -0,0 +1,26 @@
+import os
+import sys
+from batch import export_vocab, MERGE_LOG_FILE
+
+'''
+Usage: python3 export_tokens.py /path/to/tokens/directory [merge_count]
+
+Writes tokens_<merge_count>.json from the merge log (merges.jsonl) in the tokens directory
+'''
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python export_tokens.py /path/to/tokens/directory [merge_count]")
+        sys.exit(1)
+
+    tokens_dir = sys.argv[1]
+    merge_count = int(sys.argv[2]) if len(sys.argv) == 3 else None
+
+    if not os.path.isfile(os.path.join(tokens_dir, MERGE_LOG_FILE)):
+        print(f"Error: No {MERGE_LOG_FILE} found in '{tokens_dir}'.")
+        sys.exit(1)
+
+    export_vocab(tokens_dir, merge_count)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from PIL import Image
+from dataclasses import replace
 from quantize import MidiNote
 from note_token import note_sequence_to_notes
 import numpy as np
@@ -42,71 +43,234 @@ def calculate_image_match(image1, image2):
     
     return match_percentage
 
-def compare_images_piece_by_piece(image_a, image_b):
+def overlap_matches(image_a, image_b):
     '''
-    Given two binary PIL images, A & B as before, compare them piece by piece by comparing the top
-    subet of image A to the bottom subset of image B
+    Match percentage (see calculate_image_match) of every overlap of the top of one binary image
+    with the bottom of the other, computed for all overlaps at once.
+
+    The matching pixel count of row i of A with row r of B is one matrix product; every overlap
+    of A[:k] with B[-k:] is a diagonal of that matrix, and every overlap of B[:k] with A[-k:] is
+    the mirrored diagonal. The black pixel totals of each piece are prefix sums of the row counts.
+
+    Returns:
+    tuple: (normal, flip) arrays where index k - 1 holds the match of A[:k] vs B[-k:] (normal)
+    and of B[:k] vs A[-k:] (flip)
     '''
-    arr_a = np.array(image_a)
-    arr_b = np.array(image_b)
-    
+    arr_a = np.asarray(image_a) != 0
+    arr_b = np.asarray(image_b) != 0
     if arr_a.shape != arr_b.shape:
         raise ValueError("Images must have the same dimensions")
-    
-    height, _ = arr_a.shape
-    result_map = {}
-    
-    for pixel_step in range(1, height + 1):
-        piece_a = arr_a[:pixel_step, :]
-        piece_b = arr_b[-pixel_step:, :]
-        
-        piece_percentage = pixel_step / height
-        piece_match = calculate_image_match(Image.fromarray(piece_a), Image.fromarray(piece_b))
-        
-        result_map[piece_percentage] = piece_match
-    
-    return result_map
+    height = arr_a.shape[0]
+
+    # Counts are small integers, so float matrix products are exact
+    row_matches = arr_a.astype(np.float64) @ arr_b.T.astype(np.float64)
+    rows, cols = np.indices(row_matches.shape)
+    diagonals = np.bincount((cols - rows + height - 1).ravel(), weights=row_matches.ravel(), minlength=max(2 * height - 1, 0))
+    normal_matching = diagonals[height - 1:][::-1]
+    flip_matching = diagonals[:height]
+
+    rows_a = arr_a.sum(axis=1)
+    rows_b = arr_b.sum(axis=1)
+    top_a, bottom_a = np.cumsum(rows_a), np.cumsum(rows_a[::-1])
+    top_b, bottom_b = np.cumsum(rows_b), np.cumsum(rows_b[::-1])
+
+    def match(matching, total_a, total_b):
+        max_total = np.maximum(total_a, total_b)
+        return np.divide(matching, max_total, out=np.zeros(height), where=max_total > 0)
+
+    return match(normal_matching, top_a, bottom_b), match(flip_matching, top_b, bottom_a)
+
+def compare_images_piece_by_piece(image_a, image_b):
+    '''
+    Given two binary images, A & B as before, compare them piece by piece by comparing the top
+    subet of image A to the bottom subset of image B
+    '''
+    normal, _ = overlap_matches(image_a, image_b)
+    height = len(normal)
+    return {pixel_step / height: float(normal[pixel_step - 1]) for pixel_step in range(1, height + 1)}
 
 def structure_similarity(image_a, image_b):
     '''
-    Given binary images A & B, this method finds internal pattern similarity
+    Given binary images A & B, this method finds internal pattern similarity.
+    Takes numpy arrays (or anything np.asarray accepts); every overlap is scored in one pass
     '''
-    arr_a = np.array(image_a)
-    arr_b = np.array(image_b)
+    normal, flip = overlap_matches(image_a, image_b)
+    height = len(normal)
+    if height == 0:
+        return 0
+    weights = np.arange(1, height + 1) / height
+    return float(max((normal * weights).max(), (flip * weights).max(), 0))
     
-    if arr_a.shape != arr_b.shape:
+def batch_structure_similarity(query, rolls, query_height=None, heights=None):
+    '''
+    structure_similarity of one roll against every roll of a stack, in one vectorized pass
+    (same scores as calling structure_similarity once per roll).
+
+    The matching pixel counts of all row pairs are one batched matrix product, and the overlap
+    counts of every offset are its diagonal sums (see overlap_matches).
+
+    Args:
+    query: (H, W) binary roll
+    rolls: (N, H, W) binary rolls, zero-padded at the bottom to the common height H
+    query_height, heights: actual heights of the query and of each roll. If given, each pair is
+        compared at height max(query_height, heights[n]), like compare_midi_sequences pads a
+        pair to the taller roll; otherwise every pair is compared at the full height H
+
+    Returns:
+    numpy.ndarray: (N,) scores
+    '''
+    query = np.asarray(query) != 0
+    rolls = np.asarray(rolls) != 0
+    count, height, _ = rolls.shape
+    if query.shape != rolls.shape[1:]:
         raise ValueError("Images must have the same dimensions")
-    
-    match_normal = {}
-    match_flip = {}
-    match_normal = compare_images_piece_by_piece(arr_a, arr_b)
-    match_flip = compare_images_piece_by_piece(arr_b, arr_a)
-
-    match_score = 0
-    for weight, match in list(match_normal.items()) + list(match_flip.items()):
-        # print(f"{weight:.2f} -> {match:.1f}: {match * weight}")
-        match_score = max(match * weight, match_score)
-    
-    return match_score
-    
+    if count == 0 or height == 0:
+        return np.zeros(count)
+    if heights is None:
+        pair_heights = np.full(count, height)
+    else:
+        pair_heights = np.maximum(query_height, np.asarray(heights))
+
+    # row_matches[n, i, r]: matching pixels of query row i and row r of roll n (exact in float32)
+    row_matches = np.matmul(query.astype(np.float32), rolls.astype(np.float32).transpose(0, 2, 1))
+    rows, cols = np.indices((height, height))
+    diagonal_index = (np.arange(count)[:, None, None] * (2 * height - 1) + (cols - rows + height - 1)).ravel()
+    diagonals = np.bincount(diagonal_index, weights=row_matches.ravel(), minlength=count * (2 * height - 1)).reshape(count, 2 * height - 1)
+
+    # Overlap of k rows: the top k rows of one roll against rows [h - k, h) of the other
+    k = np.arange(1, height + 1)
+    valid = k[None, :] <= pair_heights[:, None]
+    offset = np.where(valid, pair_heights[:, None] - k[None, :], 0)
+    normal_matching = np.take_along_axis(diagonals, height - 1 + offset, axis=1)
+    flip_matching = np.take_along_axis(diagonals, height - 1 - offset, axis=1)
+
+    query_prefix = np.concatenate(([0], np.cumsum(query.sum(axis=1))))
+    rolls_prefix = np.concatenate((np.zeros((count, 1), dtype=np.int64), np.cumsum(rolls.sum(axis=2), axis=1)), axis=1)
+    top_query = query_prefix[k][None, :]
+    top_rolls = rolls_prefix[:, k]
+    bottom_query = query_prefix[pair_heights][:, None] - query_prefix[offset]
+    bottom_rolls = np.take_along_axis(rolls_prefix, pair_heights[:, None], axis=1) - np.take_along_axis(rolls_prefix, offset, axis=1)
+
+    def match(matching, total_a, total_b):
+        max_total = np.maximum(total_a, total_b)
+        return np.divide(matching, max_total, out=np.zeros(matching.shape), where=valid & (max_total > 0))
+
+    weights = k[None, :] / np.maximum(pair_heights, 1)[:, None]
+    scores = np.maximum(match(normal_matching, top_query, bottom_rolls) * weights, match(flip_matching, top_rolls, bottom_query) * weights)
+    return scores.max(axis=1)
+
 def normalize_notes(midi_notes: list[MidiNote]):
     '''
     Given a list of notes, subtract all notes by lowest note. Return new list of notes
+    (the given notes are not modified)
     '''
-    new_notes = []
     lowest_note = min(midi_notes, key=lambda n : n.note).note
-    for n in midi_notes:
-        n.note -= lowest_note
-        new_notes.append(n)
-    return new_notes
+    return [replace(n, note=n.note - lowest_note) for n in midi_notes]
+
+def notes_to_arrays(notes: list[MidiNote]):
+    '''
+    Returns (pitches, starts, ends) int arrays of a list of MidiNotes
+    '''
+    pitches = np.array([n.note for n in notes], dtype=np.int64)
+    starts = np.array([n.start_time for n in notes], dtype=np.int64)
+    ends = starts + np.array([n.duration for n in notes], dtype=np.int64)
+    return pitches, starts, ends
+
+def sequence_note_arrays(note_sequence):
+    '''
+    Returns (pitches, starts, ends) int arrays of a note sequence, with the timing of
+    note_sequence_to_notes (1 tick per duration unit) but without building MidiNote objects
+    '''
+    pitches, starts, ends = [], [], []
+    current_time = 0
+    for chord in note_sequence:
+        if chord[0].startswith('n_r'):  # Rest
+            current_time += int(chord[0].split('_')[2])
+        else:
+            chord_duration = 0
+            for token in chord:
+                _, note, duration = token.split('_')
+                duration = int(duration)
+                pitches.append(int(note))
+                starts.append(current_time)
+                ends.append(current_time + duration)
+                chord_duration = max(chord_duration, duration)
+            current_time += chord_duration
+    return np.array(pitches, dtype=np.int64), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+def nearest_columns(width, target_width):
+    '''
+    Source column of every column of a nearest-neighbor resize from width to target_width.
+    Computed like PIL's Image.resize(..., Image.NEAREST) does (a float step accumulated per
+    column), so the result is identical to resizing through PIL.
+    '''
+    scale = width / target_width
+    steps = np.full(target_width, scale)
+    steps[0] = scale * 0.5
+    return np.minimum(np.cumsum(steps).astype(np.int64), width - 1)
+
+def piano_roll(pitches, starts, ends, height=None, width=None, packed=False):
+    '''
+    Binary piano roll of notes given as arrays, written directly at the requested size.
+
+    Rows are pitches relative to the lowest pitch (like normalize_notes), columns are ticks.
+    With width, the roll is the nearest-neighbor resize of the full roll to width columns
+    (same as make_same_width), computed by mapping each note's tick range to its range of
+    target columns instead of drawing the full roll and resizing it.
+
+    Args:
+    pitches, starts, ends: note arrays (see notes_to_arrays / sequence_note_arrays)
+    height: number of rows, at least the pitch range (extra rows are zeros, like make_same_height)
+    width: target number of columns, or None for one column per tick
+    packed: return np.packbits of the rows (8 columns per byte) to save memory in large batches
 
+    Returns:
+    numpy.ndarray: (height, width) uint8 roll, or (height, ceil(width / 8)) if packed
+    '''
+    pitches = np.asarray(pitches, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    max_time = int(ends.max()) if len(ends) else 0
+    rows = pitches - pitches.min() if len(pitches) else pitches
+    height = height if height is not None else (int(rows.max()) + 1 if len(rows) else 0)
+    width = width if width is not None else max_time
+
+    if max_time == 0 or width == 0:
+        roll = np.zeros((height, width), dtype=np.uint8)
+    else:
+        if width == max_time:
+            first, last = starts, ends
+        else:
+            columns = nearest_columns(max_time, width)
+            first = np.searchsorted(columns, starts, side='left')
+            last = np.searchsorted(columns, ends, side='left')
+
+        # +1 where a note starts, -1 where it ends; a cell is on if the running sum is positive
+        edges = np.zeros((height, width + 1), dtype=np.int32)
+        np.add.at(edges, (rows, first), 1)
+        np.add.at(edges, (rows, last), -1)
+        roll = (np.cumsum(edges[:, :width], axis=1) > 0).astype(np.uint8)
+
+    return np.packbits(roll, axis=1) if packed else roll
+
+def unpack_piano_roll(packed_roll, width):
+    '''
+    Inverse of piano_roll(..., packed=True)
+    '''
+    return np.unpackbits(packed_roll, axis=-1, count=width)
+
+def sequence_to_piano_roll(note_sequence, height=None, width=None, packed=False):
+    '''
+    piano_roll of a note sequence (ie. [n_60_4], [n_67_4, n_64_3, n_60_4], [n_r_4], etc.)
+    '''
+    return piano_roll(*sequence_note_arrays(note_sequence), height=height, width=width, packed=packed)
 
 def notes_to_binary_image(notes: list[MidiNote]):
     """
     Convert a list of MidiNotes to a binary image representation.
     
     Args:
-    notes (list[MidiNote]): List of MidiNote objects
+    notes (list[MidiNote]): List of MidiNote objects (not modified)
     
     Returns:
     numpy.ndarray: Binary image representation of the notes
@@ -114,20 +278,8 @@ def notes_to_binary_image(notes: list[MidiNote]):
     if not notes:
         return np.array([])
     
-    # To make midi image more compact, notes are normalized
-    notes = normalize_notes(notes)
-
-    max_time = max(note.start_time + note.duration for note in notes)
-    max_note = max(notes, key=lambda n : n.note).note
-
-    # Create an empty image (all zeros)
-    image = np.zeros((max_note + 1, max_time), dtype=np.uint8)
-
-    # Fill in the image based on the notes
-    for note in notes:
-        image[note.note, note.start_time:note.start_time + note.duration] = 1
-
-    return image
+    # To make midi image more compact, notes are normalized (piano_roll rows start at the lowest note)
+    return piano_roll(*notes_to_arrays(notes))
 
 def save_binary_image(image, filename):
     """
@@ -196,23 +348,17 @@ def make_same_width(image_a, image_b, target_width):
     Returns:
     tuple: (resized_image_a, resized_image_b) with the same width
     """
-    # Convert numpy arrays to PIL Images
-    pil_a = Image.fromarray((image_a * 255).astype(np.uint8))
-    pil_b = Image.fromarray((image_b * 255).astype(np.uint8))
+    return resize_width(image_a, target_width), resize_width(image_b, target_width)
 
-    # Get original dimensions
-    height_a, _ = image_a.shape
-    height_b, _ = image_b.shape
-
-    # Resize images
-    resized_a = pil_a.resize((target_width, height_a), Image.NEAREST)
-    resized_b = pil_b.resize((target_width, height_b), Image.NEAREST)
-
-    # Convert back to numpy arrays and ensure binary (0 or 1) values
-    resized_array_a = np.array(resized_a).astype(bool).astype(np.uint8)
-    resized_array_b = np.array(resized_b).astype(bool).astype(np.uint8)
-
-    return resized_array_a, resized_array_b
+def resize_width(image, target_width):
+    '''
+    Nearest-neighbor resize of a binary image to target_width columns (same result as a PIL
+    Image.NEAREST resize, without the PIL round trip)
+    '''
+    height, width = image.shape
+    if width == 0:
+        return np.zeros((height, target_width), dtype=np.uint8)
+    return image[:, nearest_columns(width, target_width)].astype(bool).astype(np.uint8)
 
 def compare_midi_sequences(seq_a, seq_b, target_width=100):
     '''
@@ -220,21 +366,23 @@ def compare_midi_sequences(seq_a, seq_b, target_width=100):
 
     target_width (int): Controls "resolution" of midi comparison
     '''
-    notes_a = note_sequence_to_notes(seq_a)
-    notes_b = note_sequence_to_notes(seq_b)
-    
-    image_a = notes_to_binary_image(notes_a)
-    image_b = notes_to_binary_image(notes_b)
-    
-    # Make same height first
-    padded_a, padded_b = make_same_height(image_a, image_b)
-    
-    # Then make same width
-    resized_a, resized_b = make_same_width(padded_a, padded_b, target_width)
+    notes_a = sequence_note_arrays(seq_a)
+    notes_b = sequence_note_arrays(seq_b)
+
+    # Same height (pitch range of the taller one) and same width, built directly at that size
+    height = max(roll_height(notes_a[0]), roll_height(notes_b[0]))
+    resized_a = piano_roll(*notes_a, height=height, width=target_width)
+    resized_b = piano_roll(*notes_b, height=height, width=target_width)
     
     similarity = structure_similarity(resized_a, resized_b)
     return similarity
 
+def roll_height(pitches):
+    '''
+    Number of piano roll rows for the given pitches (pitch range)
+    '''
+    return int(pitches.max() - pitches.min()) + 1 if len(pitches) else 0
+
 
 def compare_midi_usage_case():
     # Example MIDI sequences
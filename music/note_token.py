@@ -1,6 +1,8 @@
 import mido
-from quantize import quantize_midi, MidiNote, get_ticks_per_beat, absolute_to_midi_notes, delta_to_absolute, temp_file_name, midi_notes_to_absolute, absolute_to_delta, DURATION_UNITS_PER_QUARTER_NOTE
+from quantize import quantize_midi_file, quantize_notes, scan_midi, MidiMetadata, events_to_notes, note_array_to_midi_notes, MidiNote, midi_notes_to_absolute, absolute_to_delta, DURATION_UNITS_PER_QUARTER_NOTE
 import os
+import heapq
+import numpy as np
 from dataclasses import dataclass
 from itertools import groupby
 
@@ -126,8 +128,7 @@ def note_sequence_to_notes(note_sequence, ticks_per_duration_unit: int = 1, defa
                     start_time=current_time,
                     velocity=default_velocity,
                     duration=duration,
-                    _note_on_msg=mido.Message('note_on', note=note, velocity=default_velocity),
-                    _note_off_msg=mido.Message('note_off', note=note, velocity=default_velocity)
+                    off_velocity=default_velocity
                 )
                 midi_notes.append(midi_note)
             
@@ -135,28 +136,92 @@ def note_sequence_to_notes(note_sequence, ticks_per_duration_unit: int = 1, defa
 
     return midi_notes
 
-def midi_to_note_sequence(midi_file, quantize_midi_file_name: str = None):
+# How notes of multi-track files are turned into a note sequence:
+# sequential: the note sequence of each track, one after another
+# merge: all tracks merged on one timeline, so simultaneous parts form chords
+# channel / instrument: all tracks merged, then one note sequence per midi channel / per
+#   program (drums on channel 10 are their own stream), one after another
+TRACK_MODES = ("sequential", "merge", "channel", "instrument")
+DRUM_CHANNEL = 9
+DRUM_INSTRUMENT = 128
+
+def merge_track_notes(track_notes: list[np.ndarray]) -> list[MidiNote]:
+    '''
+    Merges the note arrays of several tracks into one list ordered by start time, with a k-way
+    heap merge of the per-track sorted notes (ties keep track order)
+    '''
+    sorted_tracks = [note_array_to_midi_notes(notes[np.argsort(notes['start'], kind='stable')]) for notes in track_notes]
+    return list(heapq.merge(*sorted_tracks, key=lambda n: n.start_time))
+
+def program_changes(metadata: MidiMetadata) -> dict:
+    '''
+    Returns channel -> (times, programs) of every program_change in the file, ordered by time
+    '''
+    changes = {}
+    for tick, channel, program in metadata.program_changes:
+        changes.setdefault(channel, []).append((tick, program))
+    for channel, channel_changes in changes.items():
+        changes[channel] = (np.array([t for t, _ in channel_changes]), np.array([p for _, p in channel_changes]))
+    return changes
+
+def note_instrument(note: MidiNote, changes: dict) -> int:
+    '''
+    Program playing on the note's channel when it starts (0 before any program_change)
+    '''
+    if note.channel == DRUM_CHANNEL:
+        return DRUM_INSTRUMENT
+    if note.channel not in changes:
+        return 0
+    times, programs = changes[note.channel]
+    i = np.searchsorted(times, note.start_time, side='right') - 1
+    return int(programs[i]) if i >= 0 else 0
+
+def split_streams(midi_notes: list[MidiNote], key) -> list[list[MidiNote]]:
+    '''
+    Splits time-ordered notes into one list per key(note), ordered by key
+    '''
+    streams = {}
+    for note in midi_notes:
+        streams.setdefault(key(note), []).append(note)
+    return [streams[k] for k in sorted(streams)]
+
+def midi_to_note_sequence(midi_file, quantize_midi_file_name: str = None, track_mode: str = "sequential", legacy_ticks_per_beat: bool = False):
     '''
     Convert midi file to note sequence (ie. [n_60_4], [n_67_4, n_64_3, n_60_4], [n_r_4], etc.)
 
-    quantize_midi_file_name : if not None, save quantized file to path specified by this param
+    The file is parsed once and quantized in memory as note arrays (quantize_notes -> notes_to_note_sequence).
+
+    quantize_midi_file_name : if not None, also save the quantized file to path specified by this param
+    track_mode : how multi-track files are combined, one of TRACK_MODES
+    legacy_ticks_per_beat : derive the grid from the time signature like older versions did,
+        instead of the ticks_per_beat of the file header (see quantize.get_ticks_per_beat)
     '''
-    # Quantize the MIDI file
-    file_name = temp_file_name(midi_file, "temp")
+    if track_mode not in TRACK_MODES:
+        raise ValueError(f"Unknown track_mode '{track_mode}', expected one of {TRACK_MODES}")
+
+    midi = mido.MidiFile(midi_file)
+    track_event_arrays, metadata = scan_midi(midi, legacy_ticks_per_beat)
     if quantize_midi_file_name:
-        file_name = quantize_midi_file_name
-        
-    quantize_midi(midi_file, file_name)
+        quantize_midi_file(midi, scan=(track_event_arrays, metadata)).save(quantize_midi_file_name)
 
-    # Read the quantized MIDI file
-    midi = mido.MidiFile(file_name)
-    
     # create note sequence
-    TICKS_PER_BEAT = get_ticks_per_beat(midi)
+    TICKS_PER_BEAT = metadata.ticks_per_beat
+    track_notes = [quantize_notes(events_to_notes(events), TICKS_PER_BEAT) for events in track_event_arrays]
+
+    if track_mode == "sequential":
+        streams = [note_array_to_midi_notes(notes) for notes in track_notes]
+    else:
+        midi_notes = merge_track_notes(track_notes)
+        if track_mode == "merge":
+            streams = [midi_notes]
+        elif track_mode == "channel":
+            streams = split_streams(midi_notes, lambda n: n.channel)
+        else:
+            changes = program_changes(metadata)
+            streams = split_streams(midi_notes, lambda n: note_instrument(n, changes))
+
     note_sequence = []
-    for track in midi.tracks: #TODO: might be an issue if multiple tracks
-        absolute_messages = delta_to_absolute(track)
-        midi_notes = absolute_to_midi_notes(absolute_messages)
+    for midi_notes in streams:
         note_sequence += notes_to_note_sequence(midi_notes=midi_notes, ticks_per_beat=TICKS_PER_BEAT)
 
     return note_sequence
@@ -184,8 +249,7 @@ def note_sequence_to_midi(note_sequence, output_file, ticks_per_beat=480, defaul
             start_time=start_time,
             velocity=default_velocity,
             duration=duration,
-            _note_on_msg=mido.Message('note_on', note=note, velocity=default_velocity),
-            _note_off_msg=mido.Message('note_off', note=note, velocity=default_velocity)
+            off_velocity=default_velocity
         )
 
     midi_notes = []
@@ -0,0 +1,115 @@
+import os
+import ast
+import base64
+import json
+import numpy as np
+
+'''
+Compact structured encoding of note sequences.
+
+A note sequence ([n_60_4], [n_67_4, n_64_3, n_60_4], [n_r_4], ...) is packed into an int32
+array with one row per note: (chord index, pitch, duration). Rests use pitch REST_PITCH.
+Per song it is saved as <midi_file_name>_seq.npy next to <midi_file_name>_seq.json and can be
+memory-mapped, and in token files it is stored base64 encoded under "notes".
+'''
+
+REST_PITCH = -1
+
+def pack_note_sequence(note_sequence: list[list[str]]) -> np.ndarray:
+    '''
+    Converts a note sequence into an (N, 3) int32 array of (chord index, pitch, duration)
+    '''
+    rows = []
+    for chord_index, chord in enumerate(note_sequence):
+        for note in chord:
+            _, pitch, duration = note.split('_')
+            rows.append((chord_index, REST_PITCH if pitch == 'r' else int(pitch), int(duration)))
+    return np.array(rows, dtype=np.int32).reshape(-1, 3)
+
+def chord_bounds(packed: np.ndarray) -> np.ndarray:
+    '''
+    Returns the row offsets where each chord starts, plus the total row count at the end
+    '''
+    starts = np.flatnonzero(np.diff(packed[:, 0])) + 1
+    return np.concatenate(([0], starts, [len(packed)])) if len(packed) else np.zeros(1, dtype=np.int64)
+
+def note_strings(packed: np.ndarray) -> list[str]:
+    '''
+    Returns the note token of every row (ie. n_60_4, n_r_4)
+    '''
+    return [f"n_r_{duration}" if pitch == REST_PITCH else f"n_{pitch}_{duration}" for _, pitch, duration in packed.tolist()]
+
+def unpack_note_sequence(packed: np.ndarray) -> list[list[str]]:
+    '''
+    Converts a packed array back into a note sequence
+    '''
+    bounds = chord_bounds(packed).tolist()
+    notes = note_strings(packed)
+    return [notes[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+def chord_strings(packed: np.ndarray) -> list[str]:
+    '''
+    Returns the serialized chord tokens, ie. "['n_64_4', 'n_67_4']" (same as
+    encoding.serialize(unpack_note_sequence(packed))), without eval or intermediate lists
+    '''
+    bounds = chord_bounds(packed).tolist()
+    notes = note_strings(packed)
+    return ["['" + "', '".join(notes[start:end]) + "']" for start, end in zip(bounds[:-1], bounds[1:])]
+
+def save_packed_sequence(filename, note_sequence: list[list[str]]):
+    np.save(filename, pack_note_sequence(note_sequence))
+
+def load_packed_sequence(filename, mmap: bool = True) -> np.ndarray:
+    '''
+    Loads a _seq.npy file. With mmap the file is memory-mapped instead of read
+    '''
+    return np.load(filename, mmap_mode='r' if mmap else None)
+
+def save_note_sequence(midi_output_dir, midi_name, note_sequence: list[list[str]]):
+    '''
+    Saves a preprocessed note sequence as <midi_name>_seq.json and the packed <midi_name>_seq.npy
+    '''
+    seq_json_path = os.path.join(midi_output_dir, f"{midi_name}_seq.json")
+    with open(seq_json_path, 'w') as f:
+        json.dump({"seq": str(note_sequence)}, f, indent=2)
+    save_packed_sequence(os.path.join(midi_output_dir, f"{midi_name}_seq.npy"), note_sequence)
+
+def encode_packed(packed: np.ndarray) -> str:
+    '''
+    Base64 of the little-endian int32 rows, for storing packed sequences in JSON
+    '''
+    return base64.b64encode(packed.astype('<i4').tobytes()).decode('ascii')
+
+def decode_packed(encoded: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(encoded), dtype='<i4').reshape(-1, 3)
+
+def parse_seq(token_data: dict) -> list[list[str]]:
+    '''
+    Returns the note sequence of a token file entry. Uses the packed "notes" field when
+    present, otherwise parses the "seq" string with ast.literal_eval (older token files)
+    '''
+    if 'notes' in token_data:
+        return unpack_note_sequence(decode_packed(token_data['notes']))
+    return ast.literal_eval(token_data['seq'])
+
+def pack_processed_midi(processed_midi_dir):
+    '''
+    Writes the packed _seq.npy next to every _seq.json in processed_midi_dir that does not have one yet
+
+    Returns:
+    int: number of files written
+    '''
+    written = 0
+    for midi_folder in os.listdir(processed_midi_dir):
+        folder_path = os.path.join(processed_midi_dir, midi_folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for filename in os.listdir(folder_path):
+            if filename.endswith('_seq.json'):
+                npy_path = os.path.join(folder_path, filename[:-len('.json')] + '.npy')
+                if not os.path.exists(npy_path):
+                    with open(os.path.join(folder_path, filename), 'r') as f:
+                        note_sequence = ast.literal_eval(json.load(f)['seq'])
+                    save_packed_sequence(npy_path, note_sequence)
+                    written += 1
+    return written
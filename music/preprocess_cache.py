@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import hashlib
+from quantize import DURATION_UNITS_PER_QUARTER_NOTE, MAX_NOTE_QUARTER_NOTES
+
+'''
+Manifest of preprocessed midi files, so preprocess_midi only works on new or changed inputs.
+
+processed_midi_dir/manifest.json maps every source file to the content hash (sha256) it was
+processed from and the <midi_name> folder holding its outputs, together with the settings the
+outputs were made with. When the settings change, every entry is dropped.
+'''
+
+MANIFEST_FILE = "manifest.json"
+
+# Bump when note sequence extraction changes in a way the settings below do not capture
+PREPROCESS_VERSION = 1
+
+def preprocess_settings(track_mode: str = "sequential", legacy_ticks_per_beat: bool = False) -> dict:
+    '''
+    Parameters that affect preprocessed output. Cached outputs are only reused if these match
+    '''
+    return {
+        "version": PREPROCESS_VERSION,
+        "duration_units_per_quarter_note": DURATION_UNITS_PER_QUARTER_NOTE,
+        "max_note_quarter_notes": MAX_NOTE_QUARTER_NOTES,
+        "track_mode": track_mode,
+        "legacy_ticks_per_beat": legacy_ticks_per_beat,
+    }
+
+def file_hash(filename, block_size: int = 1 << 20) -> str:
+    '''
+    sha256 of the file content
+    '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def output_files(processed_midi_dir, midi_name) -> list[str]:
+    '''
+    Paths of the files preprocess_midi writes for one midi file
+    '''
+    midi_output_dir = os.path.join(processed_midi_dir, midi_name)
+    return [os.path.join(midi_output_dir, f"{midi_name}{suffix}") for suffix in ("_seq.json", "_seq.npy", "_quantized.mid")]
+
+class PreprocessManifest:
+    '''
+    Loads and updates processed_midi_dir/manifest.json.
+
+    Each entry is filename -> {"hash", "size", "mtime_ns", "output"}. Size and mtime are only
+    used to skip re-hashing files that were not touched since the last run. outputs maps each
+    content hash to the outputs made from it, so duplicate content is found without a scan.
+    '''
+    def __init__(self, processed_midi_dir, settings: dict = None):
+        self.processed_midi_dir = processed_midi_dir
+        self.filename = os.path.join(processed_midi_dir, MANIFEST_FILE)
+        self.settings = settings if settings is not None else preprocess_settings()
+        self.files = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get("settings") == self.settings:
+                self.files = manifest.get("files", {})
+            else:
+                print("Preprocessing settings changed, ignoring cached outputs")
+        self._index_outputs()
+
+    def _index_outputs(self):
+        self.outputs = {entry["hash"]: entry["output"] for entry in self.files.values()}
+
+    def _has_outputs(self, midi_name):
+        return all(os.path.isfile(path) for path in output_files(self.processed_midi_dir, midi_name))
+
+    def hash(self, midi_dir, filename) -> str:
+        '''
+        Content hash of midi_dir/filename, reusing the recorded hash if size and mtime are unchanged
+        '''
+        stat = os.stat(os.path.join(midi_dir, filename))
+        entry = self.files.get(filename)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["hash"]
+        return file_hash(os.path.join(midi_dir, filename))
+
+    def is_current(self, filename, digest) -> bool:
+        '''
+        True if filename was already processed from content with this hash and its outputs still exist
+        '''
+        entry = self.files.get(filename)
+        return entry is not None and entry["hash"] == digest and self._has_outputs(entry["output"])
+
+    def find_output(self, digest):
+        '''
+        Returns the midi_name of existing outputs processed from content with this hash, or None
+        '''
+        midi_name = self.outputs.get(digest)
+        if midi_name is not None and self._has_outputs(midi_name):
+            return midi_name
+        return None
+
+    def record(self, midi_dir, filename, digest, midi_name):
+        stat = os.stat(os.path.join(midi_dir, filename))
+        self.files[filename] = {"hash": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "output": midi_name}
+        self.outputs[digest] = midi_name
+
+    def prune(self, filenames):
+        '''
+        Drops entries of source files that are not in filenames anymore
+        '''
+        keep = set(filenames)
+        self.files = {filename: entry for filename, entry in self.files.items() if filename in keep}
+        self._index_outputs()
+
+    def save(self):
+        os.makedirs(self.processed_midi_dir, exist_ok=True)
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump({"settings": self.settings, "files": self.files}, f, indent=2)
+        os.replace(tmp_filename, self.filename)
+
+def copy_outputs(processed_midi_dir, source_name, midi_name):
+    '''
+    Copies the outputs of source_name to the <midi_name> folder, renamed for midi_name
+    '''
+    if source_name == midi_name:
+        # Same folder already (ie. song.mid and song.midi with the same content)
+        return
+    os.makedirs(os.path.join(processed_midi_dir, midi_name), exist_ok=True)
+    for source, destination in zip(output_files(processed_midi_dir, source_name), output_files(processed_midi_dir, midi_name)):
+        shutil.copyfile(source, destination)
@@ -1,53 +1,171 @@
 import os
 import sys
-import json
-from note_token import midi_to_note_sequence
+import time
+import argparse
+import traceback
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from note_token import midi_to_note_sequence, TRACK_MODES
+from packed_sequence import save_note_sequence
+from preprocess_cache import PreprocessManifest, copy_outputs, preprocess_settings
 
-def preprocess_midi(midi_dir, processed_midi_dir):
+'''
+Usage: python preprocess_midi.py /path/to/source/midi/directory /path/to/destination/directory [--workers N] [--no-cache] [--track-mode MODE] [--legacy-ticks-per-beat]
+
+Files that were already processed with the same content and settings are skipped, and files with
+identical content reuse one result (see preprocess_cache.py)
+'''
+
+def preprocess_midi_file(midi_dir, filename, processed_midi_dir, track_mode: str = "sequential", legacy_ticks_per_beat: bool = False):
+    '''
+    Quantizes one midi file and saves its note sequence in processed_midi_dir/<midi_file_name>
+
+    Returns:
+    tuple: (filename, error) where error is None on success, otherwise the formatted exception
+    '''
+    try:
+        midi_path = os.path.join(midi_dir, filename)
+        midi_name = os.path.splitext(filename)[0]
+
+        # Create a new directory in output directory with name <midi_file_name>
+        midi_output_dir = os.path.join(processed_midi_dir, midi_name)
+        os.makedirs(midi_output_dir, exist_ok=True)
+
+        # Create <midi_file_name>_quantized.mid file by calling quantize_midi
+        # Convert <midi_file_name> into note sequence tokens
+        quantized_midi_path = os.path.join(midi_output_dir, f"{midi_name}_quantized.mid")
+        note_sequence = midi_to_note_sequence(midi_path, quantize_midi_file_name=quantized_midi_path, track_mode=track_mode, legacy_ticks_per_beat=legacy_ticks_per_beat)
+
+        # Save note sequence tokens in <midi_file_name>_seq.json (and packed _seq.npy)
+        save_note_sequence(midi_output_dir, midi_name, note_sequence)
+        return filename, None
+    except Exception:
+        return filename, traceback.format_exc()
+
+def preprocess_midi(midi_dir, processed_midi_dir, workers: int = 1, chunksize: int = 16, report_every: int = 100, use_cache: bool = True, track_mode: str = "sequential", legacy_ticks_per_beat: bool = False):
     '''
     Get midi files and tokenize all of them
-    
+
     midi_dir: directory that has all midi files
     processed_midi_dir: directory to store processed midi data
+    workers: number of processes; files are handed to them in chunks of chunksize
+    report_every: print progress and throughput every report_every files
+    use_cache: skip files whose content and settings match processed_midi_dir/manifest.json,
+        and process files with identical content only once
+    track_mode: how tracks of multi-track files are combined (see note_token.TRACK_MODES)
+    legacy_ticks_per_beat: quantize with the old time-signature based resolution instead of the
+        file header, to reproduce corpora made before the header was honored
+
+    Returns:
+    dict: filename -> error message for every file that failed
     '''
 
     # Create output directory for processed midi data
     os.makedirs(processed_midi_dir, exist_ok=True)
 
-    # For each midi file in directory
-    for filename in os.listdir(midi_dir):
-        try: 
-            if filename.endswith(".mid") or filename.endswith(".midi"):
-                midi_path = os.path.join(midi_dir, filename)
-                midi_name = os.path.splitext(filename)[0]
-                
-                # Create a new directory in output directory with name <midi_file_name>
-                midi_output_dir = os.path.join(processed_midi_dir, midi_name)
-                os.makedirs(midi_output_dir, exist_ok=True)
-
-                # Create <midi_file_name>_quantized.mid file by calling quantize_midi
-                # Convert <midi_file_name> into note sequence tokens
-                quantized_midi_path = os.path.join(midi_output_dir, f"{midi_name}_quantized.mid")
-                note_sequence = midi_to_note_sequence(midi_path, quantize_midi_file_name=quantized_midi_path)
-
-                # Save note sequence tokens in <midi_file_name>_seq.json
-                seq_json_path = os.path.join(midi_output_dir, f"{midi_name}_seq.json")
-                with open(seq_json_path, 'w') as f:
-                    json.dump({"seq": str(note_sequence)}, f, indent=2)
+    filenames = [f for f in os.listdir(midi_dir) if f.endswith(".mid") or f.endswith(".midi")]
+    errors = {}
+
+    def reuse_outputs(filename, source_name):
+        '''
+        Gives filename a copy of the outputs of source_name. Returns False (and records the
+        error) if copying failed
+        '''
+        midi_name = os.path.splitext(filename)[0]
+        try:
+            copy_outputs(processed_midi_dir, source_name, midi_name)
+        except Exception:
+            errors[filename] = traceback.format_exc()
+            print(f'Error copying outputs of {source_name} for {filename}: {errors[filename].strip().splitlines()[-1]}')
+            return False
+        manifest.record(midi_dir, filename, digests[filename], midi_name)
+        return True
+
+    # Split files into unchanged, duplicates of other content and files to process
+    manifest = None
+    digests = {}
+    duplicates = {}     # filename -> filename with the same content that gets processed
+    to_process = filenames
+    if use_cache:
+        manifest = PreprocessManifest(processed_midi_dir, preprocess_settings(track_mode, legacy_ticks_per_beat))
+        manifest.prune(filenames)
+        to_process = []
+        pending = {}    # hash -> filename
+        skipped = reused = 0
+        for filename in filenames:
+            digest = digests[filename] = manifest.hash(midi_dir, filename)
+            if manifest.is_current(filename, digest):
+                skipped += 1
+                continue
+            source_name = manifest.find_output(digest)
+            if source_name is not None:
+                reused += reuse_outputs(filename, source_name)
+            elif digest in pending:
+                duplicates[filename] = pending[digest]
+            else:
+                pending[digest] = filename
+                to_process.append(filename)
+        print(f"Skipping {skipped} unchanged files, reused {reused} results for duplicate content")
+
+    start_time = time.time()
 
+    def report(done):
+        elapsed = time.time() - start_time
+        rate = done / elapsed if elapsed > 0 else 0
+        print(f"Progress: {done}/{len(to_process)} files ({rate:.1f} files/s, {len(errors)} errors)")
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(preprocess_midi_file, repeat(midi_dir), to_process, repeat(processed_midi_dir), repeat(track_mode), repeat(legacy_ticks_per_beat), chunksize=chunksize)
+    else:
+        executor = None
+        results = map(preprocess_midi_file, repeat(midi_dir), to_process, repeat(processed_midi_dir), repeat(track_mode), repeat(legacy_ticks_per_beat))
+
+    try:
+        # For each midi file in directory
+        for done, (filename, error) in enumerate(results, start=1):
+            if error is None:
                 print(f"Processed {filename}")
-        except Exception as e:
-            print(f'Error processing {filename}: {str(e)}')
+                if manifest is not None:
+                    manifest.record(midi_dir, filename, digests[filename], os.path.splitext(filename)[0])
+            else:
+                errors[filename] = error
+                print(f'Error processing {filename}: {error.strip().splitlines()[-1]}')
+            if done % report_every == 0:
+                report(done)
+                if manifest is not None:
+                    # Keep finished files recorded if the run gets killed
+                    manifest.save()
 
+        # Files with the same content as a processed file get a copy of its outputs
+        for filename, source in duplicates.items():
+            if source in errors:
+                errors[filename] = errors[source]
+                continue
+            if reuse_outputs(filename, os.path.splitext(source)[0]):
+                print(f"Reused {source} for {filename}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if manifest is not None:
+            manifest.save()
+
+    report(len(to_process))
     print("Preprocessing complete.")
+    return errors
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python preprocess_midi.py /path/to/source/midi/directory /path/to/destination/directory")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Quantize MIDI files and save their note sequences.")
+    parser.add_argument("source", help="Source directory containing MIDI files")
+    parser.add_argument("destination", help="Destination directory for processed MIDI data")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="Reprocess every file, ignoring the manifest")
+    parser.add_argument("--track-mode", choices=TRACK_MODES, default="sequential", help="How tracks of multi-track files are combined")
+    parser.add_argument("--legacy-ticks-per-beat", action="store_true", help="Use the old time-signature based resolution instead of the file header")
+    args = parser.parse_args()
 
-    source_dir = sys.argv[1]
-    destination_dir = sys.argv[2]
+    source_dir = args.source
+    destination_dir = args.destination
 
     if not os.path.isdir(source_dir):
         print(f"Error: Source directory '{source_dir}' does not exist.")
@@ -56,7 +174,11 @@ def main():
     print(f"Preprocessing MIDI files from {source_dir}")
     print(f"Saving processed files to {destination_dir}")
 
-    preprocess_midi(source_dir, destination_dir)
+    errors = preprocess_midi(source_dir, destination_dir, workers=args.workers, use_cache=not args.no_cache, track_mode=args.track_mode, legacy_ticks_per_beat=args.legacy_ticks_per_beat)
+    if errors:
+        print(f"Failed to process {len(errors)} files:")
+        for filename in errors:
+            print(f"  {filename}")
 
 if __name__ == "__main__":
     main()
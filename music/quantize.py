@@ -1,36 +1,69 @@
 import mido
 import os
-from dataclasses import dataclass
+import numpy as np
+from dataclasses import dataclass, field
 from typing import List, Optional
 from collections import defaultdict
 
-@dataclass
+@dataclass(slots=True)
 class MidiNote:
+    '''
+    A note with absolute start time and duration in ticks.
+
+    Messages are only built when a file is written (note_on_msg/note_off_msg). Notes read from a
+    file keep their original messages in _note_on_msg/_note_off_msg; other notes leave them None
+    and get plain note_on/note_off messages from channel and off_velocity.
+    '''
     note: int
     start_time: int
     velocity: int
     duration: int
+    channel: int = 0
+    off_velocity: int = 64
     _note_on_msg: mido.Message = None
     _note_off_msg: mido.Message = None
 
     def note_on_msg(self):
+        if self._note_on_msg is None:
+            return mido.Message('note_on', channel=self.channel, note=self.note, velocity=self.velocity, time=self.start_time)
         return self._note_on_msg.copy(time=self.start_time)
 
     def note_off_msg(self):
+        if self._note_off_msg is None:
+            return mido.Message('note_off', channel=self.channel, note=self.note, velocity=self.off_velocity, time=self.start_time + self.duration)
         return self._note_off_msg.copy(time=self.start_time + self.duration)
 
-@dataclass
+@dataclass(slots=True)
 class MidiMessage:
     time: int
     msg: mido.Message
 
-def get_ticks_per_beat(midi_file):
+def get_ticks_per_beat(midi_file, legacy: bool = False):
+    '''
+    Resolution of the file in ticks per quarter note, from the file header.
+
+    legacy: use the old estimate from the first time_signature (clocks_per_click * 4, 480 if
+    there is none) instead, to reproduce note sequences made before the header was honored
+    '''
+    if not legacy:
+        return midi_file.ticks_per_beat
     for track in midi_file.tracks:
         for msg in track:
             if msg.type == 'time_signature':
                 return msg.clocks_per_click * 4  # Multiply by 4 as clocks_per_click is per quarter note
     return 480  # Default value if no time signature is found
 
+@dataclass
+class MidiMetadata:
+    '''
+    Timing and instrument information of a midi file, collected by scan_midi.
+    All lists are ordered by tick (ties keep track order).
+    '''
+    ticks_per_beat: int
+    tempos: list = field(default_factory=list)              # (tick, microseconds per quarter note)
+    time_signatures: list = field(default_factory=list)     # (tick, numerator, denominator)
+    program_changes: list = field(default_factory=list)     # (tick, channel, program)
+
 def delta_to_absolute(messages):
     absolute_messages = []
     current_time = 0
@@ -64,13 +97,8 @@ def absolute_to_midi_notes(absolute_messages) -> list[MidiNote]:
                     start_time=start_time,
                     velocity=note_on_msg.velocity,
                     duration=midi_msg.time - start_time,
+                    channel=note_on_msg.channel,
                     _note_on_msg=note_on_msg,
-                    _note_off_msg=mido.Message(
-                        'note_off', 
-                        channel=note_on_msg.channel, 
-                        note=note_on_msg.note, 
-                        velocity=64, 
-                    )
                 ))
                 skip_note_off[midi_msg.msg.note] += 1
             active_notes[midi_msg.msg.note] = (midi_msg.time, midi_msg.msg)
@@ -86,6 +114,7 @@ def absolute_to_midi_notes(absolute_messages) -> list[MidiNote]:
                     start_time=start_time,
                     velocity=note_on_msg.velocity,
                     duration=midi_msg.time - start_time,
+                    channel=note_on_msg.channel,
                     _note_on_msg=note_on_msg,
                     _note_off_msg=midi_msg.msg
                 ))
@@ -110,33 +139,225 @@ def quantize_midi_notes(midi_notes, quantize_ticks, max_note_ticks):
             start_time=quantized_start,
             velocity=note.velocity,
             duration=quantized_duration,
+            channel=note.channel,
+            off_velocity=note.off_velocity,
             _note_on_msg=note._note_on_msg,
             _note_off_msg=note._note_off_msg
         ))
     return quantized_notes
 
+# Structured array representation of note events, used by the preprocessing hot path instead of
+# one MidiMessage/MidiNote object per event. index is the position of the source message in the
+# track (-1 for note_off messages that do not exist in the track).
+NOTE_ON = 1
+NOTE_OFF = -1
+OTHER_EVENT = 0
+
+EVENT_DTYPE = np.dtype([
+    ('time', np.int64),
+    ('kind', np.int8),
+    ('pitch', np.int16),
+    ('velocity', np.int16),
+    ('channel', np.int16),
+    ('index', np.int64),
+])
+
+NOTE_DTYPE = np.dtype([
+    ('pitch', np.int16),
+    ('start', np.int64),
+    ('duration', np.int64),
+    ('velocity', np.int16),
+    ('channel', np.int16),
+    ('on_index', np.int64),
+    ('off_index', np.int64),
+])
+
+def track_events(track, metadata: MidiMetadata = None) -> np.ndarray:
+    '''
+    Converts a track into an EVENT_DTYPE array with absolute times (cumulative sum of delta times).
+    If metadata is given, tempo, time signature and program changes are added to it in the same pass
+    '''
+    rows = []
+    meta_messages = []
+    for i, msg in enumerate(track):
+        if msg.type == 'note_on' or msg.type == 'note_off':
+            kind = NOTE_ON if msg.type == 'note_on' and msg.velocity > 0 else NOTE_OFF
+            rows.append((msg.time, kind, msg.note, msg.velocity, msg.channel, i))
+        else:
+            rows.append((msg.time, OTHER_EVENT, 0, 0, 0, i))
+            if msg.type in ('set_tempo', 'time_signature', 'program_change'):
+                meta_messages.append((i, msg))
+    events = np.array(rows, dtype=EVENT_DTYPE)
+    np.cumsum(events['time'], out=events['time'])
+
+    if metadata is not None:
+        for i, msg in meta_messages:
+            tick = int(events['time'][i])
+            if msg.type == 'set_tempo':
+                metadata.tempos.append((tick, msg.tempo))
+            elif msg.type == 'time_signature':
+                metadata.time_signatures.append((tick, msg.numerator, msg.denominator))
+            else:
+                metadata.program_changes.append((tick, msg.channel, msg.program))
+    return events
+
+def scan_midi(midi: mido.MidiFile, legacy_ticks_per_beat: bool = False):
+    '''
+    Extracts the events of every track and the file's metadata in one pass over the messages.
+
+    Returns:
+    tuple: (list of EVENT_DTYPE arrays, one per track, MidiMetadata)
+    '''
+    ticks_per_beat = get_ticks_per_beat(midi, legacy=True) if legacy_ticks_per_beat else midi.ticks_per_beat
+    metadata = MidiMetadata(ticks_per_beat)
+    track_event_arrays = [track_events(track, metadata) for track in midi.tracks]
+    for changes in (metadata.tempos, metadata.time_signatures, metadata.program_changes):
+        changes.sort(key=lambda x: x[0])
+    return track_event_arrays, metadata
+
+def events_to_notes(events: np.ndarray) -> np.ndarray:
+    '''
+    Array version of absolute_to_midi_notes: pairs note_on/note_off events into a NOTE_DTYPE array,
+    in the same order and with the same overlapping-note handling.
+
+    Per pitch, absolute_to_midi_notes keeps an active note plus a count of note_offs to skip
+    (fl studio overlapping notes). Their sum is a counter that a note_on increments and a
+    note_off decrements but never below 0, so it is computed for all events at once as a running
+    sum minus its running minimum. A note ends at a note_on while the counter is above 0
+    (superseded note) or at a note_off that brings the counter from 1 to 0, and it starts at the
+    last note_on of the same pitch before that.
+    '''
+    positions = np.flatnonzero(events['kind'] != OTHER_EVENT)
+    positions = positions[np.argsort(events['pitch'][positions], kind='stable')]
+    note_events = events[positions]
+    n = len(note_events)
+    if n == 0:
+        return np.zeros(0, dtype=NOTE_DTYPE)
+
+    pitch = note_events['pitch']
+    is_on = note_events['kind'] == NOTE_ON
+    step = np.where(is_on, 1, -1)
+    group_start = np.ones(n, dtype=bool)
+    group_start[1:] = pitch[1:] != pitch[:-1]
+    group = np.cumsum(group_start) - 1
+
+    # Running sum per pitch, and its running minimum per pitch (later pitches are shifted down
+    # so the minimum of an earlier pitch never carries over)
+    total = np.cumsum(step)
+    total -= (total - step)[group_start][group]
+    shift = group * (2 * n + 1)
+    running_min = np.minimum.accumulate(total - shift) + shift
+    pending = total - np.minimum(running_min, 0)
+    pending_before = np.zeros(n, dtype=pending.dtype)
+    pending_before[1:] = pending[:-1]
+    pending_before[group_start] = 0
+
+    ends = np.flatnonzero((is_on & (pending_before > 0)) | (~is_on & (pending_before == 1)))
+    last_on = np.maximum.accumulate(np.where(is_on, np.arange(n), -1))
+    starts = last_on[ends - 1]
+
+    # absolute_to_midi_notes emits notes in the order of the events that end them
+    order = np.argsort(positions[ends])
+    ends, starts = ends[order], starts[order]
+
+    notes = np.zeros(len(ends), dtype=NOTE_DTYPE)
+    notes['pitch'] = pitch[ends]
+    notes['start'] = note_events['time'][starts]
+    notes['duration'] = note_events['time'][ends] - notes['start']
+    notes['velocity'] = note_events['velocity'][starts]
+    notes['channel'] = note_events['channel'][starts]
+    notes['on_index'] = note_events['index'][starts]
+    notes['off_index'] = np.where(is_on[ends], -1, note_events['index'][ends])
+    return notes
+
+def notes_to_events(notes: np.ndarray) -> np.ndarray:
+    '''
+    Array version of midi_notes_to_absolute: note_on and note_off events of every note, stably sorted by time
+    '''
+    events = np.zeros(2 * len(notes), dtype=EVENT_DTYPE)
+    on, off = events[0::2], events[1::2]
+    on['time'] = notes['start']
+    on['kind'] = NOTE_ON
+    on['index'] = notes['on_index']
+    off['time'] = notes['start'] + notes['duration']
+    off['kind'] = NOTE_OFF
+    off['index'] = notes['off_index']
+    for event in (on, off):
+        event['pitch'] = notes['pitch']
+        event['velocity'] = notes['velocity']
+        event['channel'] = notes['channel']
+    return events[np.argsort(events['time'], kind='stable')]
+
+def quantize_note_array(notes: np.ndarray, quantize_ticks, max_note_ticks) -> np.ndarray:
+    '''
+    Array version of quantize_midi_notes (same round half to even as round())
+    '''
+    quantized = notes.copy()
+    quantized['start'] = np.rint(notes['start'] / quantize_ticks).astype(np.int64) * quantize_ticks
+    quantized['duration'] = np.minimum(np.rint(notes['duration'] / quantize_ticks).astype(np.int64) * quantize_ticks, max_note_ticks)
+    return quantized
+
+def note_array_to_midi_notes(notes: np.ndarray) -> list[MidiNote]:
+    '''
+    MidiNote objects (without messages) for code that works on note lists
+    '''
+    return [MidiNote(note=pitch, start_time=start, velocity=velocity, duration=duration, channel=channel)
+            for pitch, start, duration, velocity, channel in zip(notes['pitch'].tolist(), notes['start'].tolist(), notes['duration'].tolist(), notes['velocity'].tolist(), notes['channel'].tolist())]
+
+def note_array_messages(track, notes: np.ndarray) -> list[MidiMessage]:
+    '''
+    Note messages of a note array, stably sorted by time, for writing a midi file. Messages are
+    taken from the track by index; missing note_offs are created like absolute_to_midi_notes does
+    '''
+    absolute_messages = []
+    for event in notes_to_events(notes).tolist():
+        time, kind, pitch, _, channel, index = event
+        if index >= 0:
+            msg = track[index]
+        else:
+            msg = mido.Message('note_off', channel=channel, note=pitch, velocity=64)
+        absolute_messages.append(MidiMessage(time, msg))
+    return absolute_messages
+
 DURATION_UNITS_PER_QUARTER_NOTE = 4 # 1 quarter note = 4 duration units
+MAX_NOTE_QUARTER_NOTES = 16
 
-def quantize_midi(input_file, output_file):
-    midi = mido.MidiFile(input_file)
-    
-    TICKS_PER_BEAT = get_ticks_per_beat(midi)
-    QUANTIZE_TICKS = TICKS_PER_BEAT // DURATION_UNITS_PER_QUARTER_NOTE  # 16th note quantization
-    MAX_NOTE_TICKS = TICKS_PER_BEAT * 16  # 16 quarter notes
+def quantize_grid(ticks_per_beat):
+    '''
+    Returns (quantize_ticks, max_note_ticks): 16th note grid, notes limited to 16 quarter notes
+    '''
+    return ticks_per_beat // DURATION_UNITS_PER_QUARTER_NOTE, ticks_per_beat * MAX_NOTE_QUARTER_NOTES
+
+def quantize_notes(notes: np.ndarray, ticks_per_beat) -> np.ndarray:
+    '''
+    Quantizes a note array in memory. The quantized note events are paired into notes again
+    exactly like reading back a file written by quantize_midi would (ie. overlapping notes of the
+    same pitch are split the same way), so the result matches the file round trip.
+    '''
+    quantize_ticks, max_note_ticks = quantize_grid(ticks_per_beat)
+    quantized_notes = quantize_note_array(notes, quantize_ticks, max_note_ticks)
+    return events_to_notes(notes_to_events(quantized_notes))
+
+def quantize_midi_file(midi: mido.MidiFile, legacy_ticks_per_beat: bool = False, scan=None) -> mido.MidiFile:
+    '''
+    Returns a quantized and duration-limited copy of a parsed midi file
+
+    scan: (track event arrays, MidiMetadata) from scan_midi, if the caller already has them
+    '''
+    track_event_arrays, metadata = scan if scan is not None else scan_midi(midi, legacy_ticks_per_beat)
+    TICKS_PER_BEAT = metadata.ticks_per_beat
+    QUANTIZE_TICKS, MAX_NOTE_TICKS = quantize_grid(TICKS_PER_BEAT)
 
     new_midi = mido.MidiFile()
     new_midi.ticks_per_beat = TICKS_PER_BEAT
 
-    for track in midi.tracks:
-        absolute_messages = delta_to_absolute(track)
-        midi_notes = absolute_to_midi_notes(absolute_messages)
-        quantized_notes = quantize_midi_notes(midi_notes, QUANTIZE_TICKS, MAX_NOTE_TICKS)
-        quantized_absolute = midi_notes_to_absolute(quantized_notes)
+    for track, events in zip(midi.tracks, track_event_arrays):
+        quantized_notes = quantize_note_array(events_to_notes(events), QUANTIZE_TICKS, MAX_NOTE_TICKS)
+        quantized_absolute = note_array_messages(track, quantized_notes)
         
         # Preserve non-note messages
-        for msg in absolute_messages:
-            if msg.msg.type not in ['note_on', 'note_off']:
-                quantized_absolute.append(msg)
+        for time, index in events[['time', 'index']][events['kind'] == OTHER_EVENT].tolist():
+            quantized_absolute.append(MidiMessage(time, track[index]))
         
         quantized_absolute.sort(key=lambda x: x.time)
         delta_messages = absolute_to_delta(quantized_absolute)
@@ -144,9 +365,14 @@ def quantize_midi(input_file, output_file):
         new_track = mido.MidiTrack(delta_messages)
         new_midi.tracks.append(new_track)
 
+    return new_midi
+
+def quantize_midi(input_file, output_file):
+    midi = mido.MidiFile(input_file)
+    new_midi = quantize_midi_file(midi)
     new_midi.save(output_file)
     print(f"Quantized and duration-limited MIDI saved as: {output_file}")
-    print(f"TICKS_PER_BEAT: {TICKS_PER_BEAT}")
+    print(f"TICKS_PER_BEAT: {new_midi.ticks_per_beat}")
 
 def temp_file_name(input_file, temp_file_name=None):
     file_name, file_extension = os.path.splitext(input_file)
@@ -2,6 +2,7 @@ import json
 import sys
 import os
 from note_token import note_sequence_to_midi
+from packed_sequence import parse_seq
 
 def load_abstracted_tokens(file_path):
     with open(file_path, 'r') as f:
@@ -14,7 +15,7 @@ def load_tokens(file_path):
 def render_representative_token(rep_token, index, tokens, destination, separator=['n_r_64']):
     concatenated_sequence = []
     for token in rep_token['tokens']:
-        token_sequence = eval(tokens[token]['seq'])
+        token_sequence = parse_seq(tokens[token])
         concatenated_sequence.extend(token_sequence)
         concatenated_sequence.extend([separator])  # Add 1-measure rest
 
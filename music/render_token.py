@@ -3,6 +3,7 @@ import json
 from quantize import quantize_midi
 from note_token import midi_to_note_sequence, note_sequence_to_midi
 from encoding import serialize, generate_vocab_list, detokenize, deserialize
+from packed_sequence import parse_seq
 
 def render_token(token_file, token_to_render):
     if not os.path.isfile(token_file):
@@ -18,8 +19,7 @@ def render_token(token_file, token_to_render):
         return
     
     # Get note sequence from token file
-    note_sequence_str = token_data[token_to_render]['seq']
-    note_sequence = eval(note_sequence_str)  # Convert string representation to list
+    note_sequence = parse_seq(token_data[token_to_render])
 
     # Save note sequence to MIDI file
     output_file = f"t_{token_to_render[2:]}.mid"  # Assuming token format is 't_X'
@@ -51,8 +51,7 @@ def main():
         return
 
     # Get note sequence from token file
-    note_sequence_str = token_data[token_to_render]['seq']
-    note_sequence = eval(note_sequence_str)  # Convert string representation to list
+    note_sequence = parse_seq(token_data[token_to_render])
 
     # Save note sequence to MIDI file
     output_file = f"t_{token_to_render[2:]}.mid"  # Assuming token format is 't_X'
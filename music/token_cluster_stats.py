@@ -5,10 +5,15 @@ from scipy.cluster.hierarchy import dendrogram, linkage
 from scipy.spatial.distance import squareform
 import matplotlib.pyplot as plt
 from sklearn.manifold import MDS
+from cluster_progressive import matrix_file_name, square_similarity_matrix
 
 def load_similarity_matrix(filename):
     data = np.load(filename)
-    similarity_matrix = data['similarity_matrix']
+    if 'similarity_matrix' in data.files:
+        similarity_matrix = data['similarity_matrix']
+    else:
+        # cluster_progressive stores the condensed matrix next to the token list
+        similarity_matrix = square_similarity_matrix(np.load(matrix_file_name(filename), mmap_mode='r'))
     tokens = data['tokens']
     return similarity_matrix, tokens
 
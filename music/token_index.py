@@ -0,0 +1,193 @@
+import os
+import json
+import argparse
+import numpy as np
+from scipy.sparse import csr_matrix
+from cluster_progressive import load_tokens, rasterize_tokens
+from midi_similarity import batch_structure_similarity, unpack_piano_roll
+
+'''
+Usage: python3 token_index.py /path/to/token/file /path/to/similarity_graph.npz
+
+Approximate nearest neighbors of BPE tokens, so token similarity does not need all n^2 pairs.
+
+Every token's piano roll (see cluster_progressive.rasterize_tokens) is embedded as its column
+profile: the number of active pitches at each time step, plus the roll height. structure_similarity
+slides the rolls vertically (pitch) against each other, which leaves the column profile unchanged,
+and weights each overlap by its share of the taller roll, so similar tokens have similar profiles
+and heights. The profiles are hashed with random hyperplanes (SimHash) into several LSH tables;
+the tokens sharing a bucket with a token are its candidates, and the exact structure_similarity
+is only computed for those.
+'''
+
+def roll_profiles(rolls, heights, width=None, chunk_size: int = 4096):
+    '''
+    Centered, unit-length column profiles (with the height appended) of an (n, height, width)
+    stack of rolls. If width is given the rolls are packed, and are unpacked chunk_size at a time.
+    '''
+    profiles = np.empty((len(rolls), (width if width is not None else rolls.shape[2]) + 1), dtype=np.float32)
+    for start in range(0, len(rolls), chunk_size):
+        chunk = rolls[start:start + chunk_size]
+        if width is not None:
+            chunk = unpack_piano_roll(chunk, width)
+        profiles[start:start + chunk_size, :-1] = chunk.sum(axis=1)
+    profiles[:, -1] = heights
+    if len(profiles) == 0:
+        return profiles
+    profiles -= profiles.mean(axis=0)
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    return np.divide(profiles, norms, out=np.zeros_like(profiles), where=norms > 0)
+
+class RollIndex:
+    '''
+    Random hyperplane LSH index over the column profiles of a stack of rolls.
+
+    Each of the tables hashes a profile to the signs of bits random projections; tokens in the
+    same bucket of any table are candidates. More bits make buckets smaller (fewer, closer
+    candidates), more tables raise the chance that similar tokens share at least one bucket.
+
+    rolls: (n, height, width) stack of rolls, or packed rolls (see
+        cluster_progressive.rasterize_tokens) if width is given. Only the candidates of one token
+        at a time are unpacked, so the index holds about n * height * width / 8 bytes of rolls
+        plus 8 bytes per token and table for the buckets
+    bits: defaults to log2(n) - 4, so buckets hold a few dozen tokens whatever the vocab size
+    '''
+    def __init__(self, rolls, heights, tables: int = 8, bits: int = None, seed: int = 0, width: int = None):
+        if bits is None:
+            bits = max(4, int(np.log2(max(len(heights), 1))) - 4)
+        if not 0 < bits < 63:
+            raise ValueError("bits must be between 1 and 62")
+        self.rolls = rolls
+        self.heights = np.asarray(heights)
+        self.width = width
+        profiles = roll_profiles(rolls, heights, width)
+        hyperplanes = np.random.default_rng(seed).standard_normal((tables, profiles.shape[1], bits)).astype(np.float32)
+        powers = 1 << np.arange(bits, dtype=np.int64)
+        # keys[t, i]: bucket of token i in table t
+        self.keys = np.stack([((profiles @ planes) > 0) @ powers for planes in hyperplanes])
+        self.order = np.argsort(self.keys, axis=1, kind='stable')
+        self.sorted_keys = np.take_along_axis(self.keys, self.order, axis=1)
+
+    def __len__(self):
+        return len(self.heights)
+
+    def roll(self, indices):
+        '''
+        Unpacked roll(s) of the given token index or indices
+        '''
+        return unpack_piano_roll(self.rolls[indices], self.width) if self.width is not None else self.rolls[indices]
+
+    def candidates(self, i, max_candidates: int = None):
+        '''
+        Indices of the tokens sharing a bucket with token i in any table (without i itself).
+        If there are more than max_candidates, keeps those sharing the most buckets with i.
+        '''
+        found = []
+        for table, key in enumerate(self.keys[:, i]):
+            start, end = np.searchsorted(self.sorted_keys[table], [key, key + 1])
+            found.append(self.order[table, start:end])
+        candidates, collisions = np.unique(np.concatenate(found), return_counts=True)
+        keep = candidates != i
+        candidates, collisions = candidates[keep], collisions[keep]
+        if max_candidates is not None and len(candidates) > max_candidates:
+            candidates = np.sort(candidates[np.argsort(-collisions, kind='stable')[:max_candidates]])
+        return candidates
+
+    def neighbors(self, i, k: int = 10, min_similarity: float = 0.0, max_candidates: int = None):
+        '''
+        The k candidates most similar to token i by the exact structure_similarity.
+
+        Returns:
+        tuple: (indices, scores) sorted by decreasing similarity, only scores above min_similarity
+        '''
+        candidates = self.candidates(i, max_candidates)
+        scores = batch_structure_similarity(self.roll(i), self.roll(candidates), self.heights[i], self.heights[candidates])
+        keep = scores > min_similarity
+        candidates, scores = candidates[keep], scores[keep]
+        best = np.argsort(-scores, kind='stable')[:k]
+        return candidates[best], scores[best]
+
+def knn_graph(index: RollIndex, k: int = 10, min_similarity: float = 0.0, max_candidates: int = 1000):
+    '''
+    Sparse kNN similarity graph: every token is linked to its k most similar candidates.
+
+    Returns:
+    scipy.sparse.csr_matrix: symmetric (n, n) float32 matrix of similarities, an edge is kept if
+    either token is among the other's neighbors
+    '''
+    n = len(index)
+    if n == 0:
+        return csr_matrix((0, 0), dtype=np.float32)
+    rows, cols, scores = [], [], []
+    for i in range(n):
+        neighbors, neighbor_scores = index.neighbors(i, k, min_similarity, max_candidates)
+        rows.append(np.full(len(neighbors), i))
+        cols.append(neighbors)
+        scores.append(neighbor_scores)
+        if (i + 1) % 10000 == 0:
+            print(f"Searched neighbors of {i + 1}/{n} tokens")
+    graph = csr_matrix((np.concatenate(scores).astype(np.float32), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+    return graph.maximum(graph.T).tocsr()
+
+def knn_graph_settings(k: int = 10, min_similarity: float = 0.0, target_width: int = 100, tables: int = 8, bits: int = None, max_candidates: int = 1000, seed: int = 0) -> dict:
+    '''
+    Parameters of token_knn_graph, saved with the graph so a cached graph is only reused if they match
+    '''
+    return {
+        "k": k,
+        "min_similarity": min_similarity,
+        "target_width": target_width,
+        "tables": tables,
+        "bits": bits,
+        "max_candidates": max_candidates,
+        "seed": seed,
+    }
+
+def token_knn_graph(tokens, k: int = 10, min_similarity: float = 0.0, target_width: int = 100, tables: int = 8, bits: int = None, max_candidates: int = 1000, seed: int = 0):
+    '''
+    Rasterizes the tokens and builds their kNN similarity graph (see knn_graph)
+    '''
+    rolls, heights = rasterize_tokens(tokens, list(tokens.keys()), target_width, packed=True)
+    index = RollIndex(rolls, heights, tables, bits, seed, width=target_width)
+    return knn_graph(index, k, min_similarity, max_candidates)
+
+def save_similarity_graph(graph, tokens, filename, settings: dict = None):
+    '''
+    settings: the knn_graph_settings the graph was built with
+    '''
+    graph = graph.tocsr()
+    np.savez(filename, data=graph.data, indices=graph.indices, indptr=graph.indptr, shape=graph.shape, tokens=tokens, settings=json.dumps(settings or {}))
+
+def load_similarity_graph(filename):
+    '''
+    Returns:
+    tuple: (graph, tokens, settings)
+    '''
+    data = np.load(filename)
+    graph = csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+    settings = json.loads(str(data['settings'])) if 'settings' in data.files else {}
+    return graph, data['tokens'], settings
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the sparse kNN similarity graph of BPE tokens")
+    parser.add_argument("token_file", help="JSON file of tokens")
+    parser.add_argument("graph_file", help="Output .npz file")
+    parser.add_argument("--k", type=int, default=10, help="Neighbors per token")
+    parser.add_argument("--min-similarity", type=float, default=0.0, help="Drop neighbors with this similarity or lower")
+    parser.add_argument("--tables", type=int, default=8, help="Number of LSH tables")
+    parser.add_argument("--bits", type=int, default=None, help="Hyperplanes per LSH table (default: log2 of the token count - 4)")
+    parser.add_argument("--max-candidates", type=int, default=1000, help="Exact comparisons per token at most")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.token_file):
+        print(f"Error: Token file '{args.token_file}' does not exist.")
+        return
+
+    tokens = load_tokens(args.token_file)
+    settings = knn_graph_settings(args.k, args.min_similarity, tables=args.tables, bits=args.bits, max_candidates=args.max_candidates)
+    graph = token_knn_graph(tokens, **settings)
+    save_similarity_graph(graph, list(tokens.keys()), args.graph_file, settings)
+    print(f"Saved {graph.nnz // 2} edges between {len(tokens)} tokens to {args.graph_file}")
+
+if __name__ == "__main__":
+    main()
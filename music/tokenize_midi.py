@@ -1,17 +1,19 @@
 import os
 import sys
 import json
-from batch import batch_generate_vocab_list_progressive, create_all_note_sequence_tokens
+from batch import batch_generate_vocab_list_progressive
+from corpus import NoteSequenceCorpus
 
 '''
 Usage: python3 tokenize_midi.py /path/to/preprocessed/midi/directory /path/to/tokens/directory 
 '''
 
 def load_note_sequences(preprocessed_dir):
-    all_note_sequences = create_all_note_sequence_tokens(preprocessed_dir)
+    # Streamed from disk, so the string tokens of the whole corpus are never held in memory
+    all_note_sequences = NoteSequenceCorpus(preprocessed_dir)
     return all_note_sequences
 
-def tokenize_midi(preprocessed_dir, tokens_dir, num_merges=500_000, save_every_n_merges=5000):
+def tokenize_midi(preprocessed_dir, tokens_dir, num_merges=500_000, save_every_n_merges=5000, workers=1):
     print(f"Loading note sequences from {preprocessed_dir}")
     all_note_sequence_tokens = load_note_sequences(preprocessed_dir)
     
@@ -20,7 +22,8 @@ def tokenize_midi(preprocessed_dir, tokens_dir, num_merges=500_000, save_every_n
         all_note_sequence_tokens,
         num_merges=num_merges,
         save_every_n_merges=save_every_n_merges,
-        tokens_dir=tokens_dir
+        tokens_dir=tokens_dir,
+        workers=workers
     )
     
     print(f"Tokenization complete. Tokens saved in {tokens_dir}")